@@ -0,0 +1,94 @@
+"""In-process read-through cache for per-user lookups.
+
+Users, their artworks and paper balances are read on every menu open but
+only change when the atelier adds something, so ``db.py`` serves them from
+here and the writers invalidate the affected entries. Entries also expire
+after ``USER_CACHE_TTL`` seconds, which bounds staleness when another
+process writes to the same database.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from atelier_bot.services.metrics import Counter
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+MISSING = object()
+
+CACHE_LOOKUPS = Counter(
+    "atelier_cache_lookups_total", "Cache lookups by cache and result",
+    ("cache", "result"))
+
+
+class TTLCache:
+    """LRU cache whose entries also expire ``ttl`` seconds after loading."""
+
+    def __init__(
+        self, maxsize: int, ttl: float, name: Optional[str] = None
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Named caches also count their hits and misses on /metrics
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        # Bumped by every invalidation; a load that started before one
+        # must not store what it read
+        self._version = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Return the cached value or ``MISSING``."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            if self.name is not None:
+                CACHE_LOOKUPS.inc(cache=self.name, result="miss")
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        if self.name is not None:
+            CACHE_LOOKUPS.inc(cache=self.name, result="hit")
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_load(
+        self, key: Hashable, load: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+        version = self._version
+        value = await load()
+        if version == self._version:
+            self.set(key, value)
+        return value
+
+    def invalidate(self, *keys: Hashable) -> None:
+        self._version += 1
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._version += 1
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._data)}
+
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, name="user")
@@ -1,131 +1,241 @@
-import base64
+import json
+import logging
 import os
+import time
 from io import BytesIO
-from typing import List, Optional
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
 
 import aiosqlite
 from PIL import Image
 
+from atelier_bot.db.cache import user_cache
+from atelier_bot.db.migrations import migrate
+from atelier_bot.db.pool import reader, writer
+from atelier_bot.db.user_index import user_index
+from atelier_bot.services.metrics import Counter, Histogram, timed
+
+logger = logging.getLogger(__name__)
+
 # Use persistent storage in Docker, local file for development
 DB_PATH = "/shared/atelier.db" if os.path.exists("/shared") else "atelier.db"
 
 
-def create_artwork_icon(image_data: bytes, size: tuple = (100, 100)) -> str:
-    """Create a thumbnail icon from image data and return as base64 string."""
-    try:
-        # Open image from bytes
-        image = Image.open(BytesIO(image_data))
+DB_QUERY_SECONDS = Histogram(
+    "atelier_db_query_seconds", "Time spent in a database helper",
+    ("query",))
+DB_ERRORS = Counter(
+    "atelier_db_errors_total", "Database helpers that raised", ("query",))
+
+
+def _timed(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Record the duration and errors of ``fn`` under its name."""
+    return timed(DB_QUERY_SECONDS, DB_ERRORS, query=fn.__name__)(fn)
+
+
+# Most users returned by search_users
+SEARCH_LIMIT = 10
+
+# Rows per page of the artwork and paper keyboards
+PAGE_SIZE = 8
+
+# Longest side, in pixels, of each stored artwork rendition
+RENDITION_SIZES = (100, 320, 800)
+
+# Pillow format for renditions, e.g. JPEG or WEBP
+RENDITION_FORMAT = os.getenv("RENDITION_FORMAT", "JPEG").upper()
+
 
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+def _render_thumbnails(
+    image_data: bytes, boxes: List[tuple], fmt: str
+) -> Dict[tuple, bytes]:
+    """Encode one thumbnail per bounding box from a single decode."""
+    # Open image from bytes
+    image = Image.open(BytesIO(image_data))
 
-        # Create thumbnail
-        image.thumbnail(size, Image.Resampling.LANCZOS)
+    # Let the JPEG decoder downscale by 1/2..1/8 while decoding, so a
+    # large photo is never expanded to full resolution in memory
+    image.draft('RGB', (max(w for w, _ in boxes), max(h for _, h in boxes)))
 
-        # Save to bytes buffer
+    # Convert to RGB if necessary
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # Shrink in place from the largest box down, reusing each result
+    thumbnails = {}
+    for box in sorted(boxes, key=lambda b: b[0] * b[1], reverse=True):
+        image.thumbnail(box, Image.Resampling.LANCZOS)
         buffer = BytesIO()
-        image.save(buffer, format='JPEG', quality=85)
-        buffer.seek(0)
+        image.save(buffer, format=fmt, quality=85)
+        thumbnails[box] = buffer.getvalue()
+    return thumbnails
 
-        # Convert to base64
-        icon_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return f"data:image/jpeg;base64,{icon_base64}"
 
+def create_artwork_renditions(
+    image_data: bytes,
+    sizes: tuple = RENDITION_SIZES,
+    fmt: str = RENDITION_FORMAT,
+) -> Optional[Dict[int, bytes]]:
+    """Create every rendition from one decode, keyed by longest side."""
+    try:
+        thumbnails = _render_thumbnails(
+            image_data, [(size, size) for size in sizes], fmt)
+        return {size: thumbnails[(size, size)] for size in sizes}
     except Exception as e:
-        print(f"Error creating icon: {e}")
+        logger.error("Error creating renditions: %s", e)
         return None
 
 
-CREATE_TABLES_SQL = """
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    username TEXT
-);
-
-CREATE TABLE IF NOT EXISTS paper_balance (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    paper_name TEXT NOT NULL,
-    quantity INTEGER NOT NULL DEFAULT 0,
-    FOREIGN KEY(user_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS artworks (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    artwork_name TEXT NOT NULL,
-    image_icon TEXT,
-    FOREIGN KEY(user_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS orders (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    artwork_name TEXT NOT NULL,
-    paper_name TEXT NOT NULL,
-    copies INTEGER NOT NULL,
-    sheets INTEGER NOT NULL,
-    status TEXT NOT NULL,
-    created_at TEXT NOT NULL
-);
-"""
+@_timed
+async def init_db(path: str = DB_PATH) -> None:
+    """Open the pool for ``path`` and apply pending schema migrations."""
+    async with writer(path) as db:
+        await migrate(db)
+
+
+async def _fetch_page(
+    sql: str,
+    params: tuple,
+    after_id: Optional[int],
+    before_id: Optional[int],
+    limit: int,
+    db_path: str,
+) -> dict:
+    """Run a keyset-paginated query, ``sql`` ending in its WHERE clause.
+
+    Pages forward from ``after_id`` (or the start) or backward from
+    ``before_id``; one extra row is read to tell whether more follow.
+    Returns ``{"items", "has_prev", "has_next"}``.
+    """
+    if before_id is not None:
+        sql += " AND id < ? ORDER BY id DESC LIMIT ?"
+        params += (before_id, limit + 1)
+    else:
+        sql += " AND id > ? ORDER BY id LIMIT ?"
+        params += (after_id or 0, limit + 1)
+    async with reader(db_path) as db:
+        cur = await db.execute(sql, params)
+        rows = await cur.fetchall()
+        await cur.close()
+    items = [dict(r) for r in rows[:limit]]
+    more = len(rows) > limit
+    if before_id is not None:
+        items.reverse()
+        return {"items": items, "has_prev": more, "has_next": True}
+    return {"items": items, "has_prev": bool(after_id), "has_next": more}
 
 
-async def init_db(path: str = DB_PATH) -> None:
-    async with aiosqlite.connect(path) as db:
-        await db.executescript(CREATE_TABLES_SQL)
-        await db.commit()
+async def _cached_first_page(
+    kind: str,
+    user_id: int,
+    after_id: Optional[int],
+    before_id: Optional[int],
+    limit: int,
+    db_path: str,
+    load: Callable[[], Awaitable[dict]],
+) -> dict:
+    """Serve the first page of a listing from ``user_cache``.
+
+    That's the page every menu open shows; later pages are read directly.
+    """
+    if after_id is not None or before_id is not None or limit != PAGE_SIZE:
+        return await load()
+    page = await user_cache.get_or_load(
+        (f"{kind}_page", db_path, user_id), load)
+    return {**page, "items": [dict(i) for i in page["items"]]}
+
+
+# Per-user reads are served from ``user_cache``; writers call this after
+# committing so the next read sees their change
+def _invalidate_user(db_path: str, user_id: int, *kinds: str) -> None:
+    keys = []
+    for kind in kinds:
+        keys.append((kind, db_path, user_id))
+        if kind in ("papers", "artworks"):
+            keys.append((f"{kind}_page", db_path, user_id))
+    user_cache.invalidate(*keys)
 
 
 # Users
+@_timed
 async def get_user(user_id: int, db_path: str = DB_PATH) -> Optional[dict]:
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute(
-            "SELECT user_id, username FROM users WHERE user_id = ?",
-            (user_id,),
-        )
-        row = await cur.fetchone()
-        await cur.close()
-        if row:
-            return dict(row)
-        return None
+    async def load() -> Optional[dict]:
+        async with reader(db_path) as db:
+            cur = await db.execute(
+                "SELECT user_id, username FROM users WHERE user_id = ?",
+                (user_id,),
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            return dict(row) if row else None
 
+    user = await user_cache.get_or_load(("user", db_path, user_id), load)
+    return dict(user) if user else None
 
+
+@_timed
 async def create_or_update_user(
     user_id: int, username: Optional[str], db_path: str = DB_PATH
 ) -> None:
-    async with aiosqlite.connect(db_path) as db:
+    # An upsert rather than INSERT OR REPLACE: REPLACE deletes the old row
+    # without firing the delete trigger, leaving users_fts out of sync.
+    # Unchanged usernames are not rewritten at all.
+    async with writer(db_path) as db:
         await db.execute(
-            "INSERT OR REPLACE INTO users (user_id, username)"
-            " VALUES (?, ?)",
+            "INSERT INTO users (user_id, username) VALUES (?, ?)"
+            " ON CONFLICT (user_id) DO UPDATE"
+            " SET username = excluded.username"
+            " WHERE username IS NOT excluded.username",
             (user_id, username),
         )
-        await db.commit()
+    _invalidate_user(db_path, user_id, "user")
+    if user_index.db_path == db_path:
+        user_index.add(user_id, username)
 
 
 # Paper balance
+@_timed
 async def get_papers_for_user(
     user_id: int, db_path: str = DB_PATH
 ) -> List[dict]:
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute(
+    async def load() -> List[dict]:
+        async with reader(db_path) as db:
+            cur = await db.execute(
+                "SELECT id, paper_name, quantity FROM paper_balance"
+                " WHERE user_id = ? ORDER BY id",
+                (user_id,),
+            )
+            rows = await cur.fetchall()
+            await cur.close()
+            return [dict(r) for r in rows]
+
+    papers = await user_cache.get_or_load(("papers", db_path, user_id), load)
+    return [dict(p) for p in papers]
+
+
+@_timed
+async def get_papers_page(
+    user_id: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = PAGE_SIZE,
+    db_path: str = DB_PATH,
+) -> dict:
+    async def load() -> dict:
+        return await _fetch_page(
             "SELECT id, paper_name, quantity FROM paper_balance"
             " WHERE user_id = ?",
-            (user_id,),
+            (user_id,), after_id, before_id, limit, db_path,
         )
-        rows = await cur.fetchall()
-        await cur.close()
-        return [dict(r) for r in rows]
+
+    return await _cached_first_page(
+        "papers", user_id, after_id, before_id, limit, db_path, load)
 
 
+@_timed
 async def get_paper_by_id(
     paper_id: int, db_path: str = DB_PATH
 ) -> Optional[dict]:
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
+    async with reader(db_path) as db:
         cur = await db.execute(
             "SELECT id, paper_name, quantity, user_id FROM paper_balance"
             " WHERE id = ?",
@@ -136,83 +246,122 @@ async def get_paper_by_id(
         return dict(row) if row else None
 
 
-async def decrement_paper(
-    paper_id: int, amount: int, db_path: str = DB_PATH
-) -> None:
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute(
-            "UPDATE paper_balance SET quantity = quantity - ?"
-            " WHERE id = ?",
-            (amount, paper_id),
-        )
-        await db.commit()
-
-
+@_timed
 async def update_paper_quantity(
     paper_id: int, new_quantity: int, db_path: str = DB_PATH
 ) -> None:
     """Update paper quantity to a specific value."""
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute(
-            "UPDATE paper_balance SET quantity = ? WHERE id = ?",
+    async with writer(db_path) as db:
+        cur = await db.execute(
+            "UPDATE paper_balance SET quantity = ? WHERE id = ?"
+            " RETURNING user_id",
             (new_quantity, paper_id),
         )
-        await db.commit()
+        row = await cur.fetchone()
+        await cur.close()
+    if row:
+        _invalidate_user(db_path, row[0], "papers")
 
 
+@_timed
 async def add_paper_for_user(
     user_id: int, paper_name: str, quantity: int, db_path: str = DB_PATH
 ) -> None:
-    async with aiosqlite.connect(db_path) as db:
+    async with writer(db_path) as db:
         await db.execute(
             "INSERT INTO paper_balance (user_id, paper_name, quantity)"
             " VALUES (?, ?, ?)",
             (user_id, paper_name, quantity),
         )
-        await db.commit()
+    _invalidate_user(db_path, user_id, "papers")
 
 
 # Artworks
+@_timed
 async def get_artworks_for_user(
     user_id: int, db_path: str = DB_PATH
 ) -> List[dict]:
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute(
-            "SELECT id, artwork_name, image_icon FROM artworks "
-            "WHERE user_id = ?",
-            (user_id,),
+    """List a user's artworks; image bytes are fetched separately."""
+    async def load() -> List[dict]:
+        async with reader(db_path) as db:
+            cur = await db.execute(
+                "SELECT id, artwork_name, image_id,"
+                " image_id IS NOT NULL AS has_icon"
+                " FROM artworks WHERE user_id = ? ORDER BY id",
+                (user_id,),
+            )
+            rows = await cur.fetchall()
+            await cur.close()
+            return [dict(r) for r in rows]
+
+    artworks = await user_cache.get_or_load(
+        ("artworks", db_path, user_id), load)
+    return [dict(a) for a in artworks]
+
+
+@_timed
+async def get_artworks_page(
+    user_id: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = PAGE_SIZE,
+    db_path: str = DB_PATH,
+) -> dict:
+    async def load() -> dict:
+        return await _fetch_page(
+            "SELECT id, artwork_name, image_id, image_id IS NOT NULL"
+            " AS has_icon FROM artworks WHERE user_id = ?",
+            (user_id,), after_id, before_id, limit, db_path,
         )
-        rows = await cur.fetchall()
-        await cur.close()
-        return [dict(r) for r in rows]
 
+    return await _cached_first_page(
+        "artworks", user_id, after_id, before_id, limit, db_path, load)
 
+
+@_timed
 async def create_artwork(
     user_id: int,
     artwork_name: str,
-    image_icon: Optional[str] = None,
+    image_id: Optional[int] = None,
     db_path: str = DB_PATH
 ) -> None:
-    async with aiosqlite.connect(db_path) as db:
+    async with writer(db_path) as db:
         await db.execute(
-            "INSERT INTO artworks (user_id, artwork_name, image_icon) "
+            "INSERT INTO artworks (user_id, artwork_name, image_id) "
             "VALUES (?, ?, ?)",
-            (user_id, artwork_name, image_icon),
+            (user_id, artwork_name, image_id),
+        )
+    _invalidate_user(db_path, user_id, "artworks")
+
+
+@_timed
+async def get_artwork_by_id(
+    artwork_id: int, user_id: int, db_path: str = DB_PATH
+) -> Optional[dict]:
+    """Look up one of ``user_id``'s artworks by primary key."""
+    async with reader(db_path) as db:
+        cur = await db.execute(
+            "SELECT id, artwork_name, image_id,"
+            " image_id IS NOT NULL AS has_icon"
+            " FROM artworks WHERE id = ? AND user_id = ?",
+            (artwork_id, user_id),
         )
-        await db.commit()
+        row = await cur.fetchone()
+        await cur.close()
+        return dict(row) if row else None
 
 
+@_timed
 async def get_artwork_by_name_and_user(
     user_id: int,
     artwork_name: str,
     db_path: str = DB_PATH
 ) -> Optional[dict]:
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
+    async with reader(db_path) as db:
         cur = await db.execute(
-            "SELECT id, artwork_name, image_icon FROM artworks "
-            "WHERE user_id = ? AND artwork_name = ?",
+            "SELECT id, artwork_name, image_id,"
+            " image_id IS NOT NULL AS has_icon"
+            " FROM artworks WHERE user_id = ? AND artwork_name = ?",
             (user_id, artwork_name),
         )
         row = await cur.fetchone()
@@ -220,44 +369,321 @@ async def get_artwork_by_name_and_user(
         return dict(row) if row else None
 
 
+# Images
+@_timed
+async def create_image(
+    renditions: Dict[int, bytes],
+    fmt: str = RENDITION_FORMAT,
+    source_keys: Iterable[str] = (),
+    db_path: str = DB_PATH,
+) -> int:
+    """Store an image's renditions and return the new image id.
+
+    ``source_keys`` fingerprint the upload so the same photo can later be
+    matched with ``find_image_by_source`` instead of being processed again.
+    """
+    async with writer(db_path) as db:
+        cur = await db.execute(
+            "INSERT INTO images (format) VALUES (?)", (fmt,)
+        )
+        image_id = cur.lastrowid
+        await cur.close()
+        await db.executemany(
+            "INSERT INTO image_renditions (image_id, size, data)"
+            " VALUES (?, ?, ?)",
+            [(image_id, size, data) for size, data in renditions.items()],
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO image_sources (source_key, image_id)"
+            " VALUES (?, ?)",
+            [(key, image_id) for key in source_keys],
+        )
+        return image_id
+
+
+@_timed
+async def find_image_by_source(
+    source_key: str, db_path: str = DB_PATH
+) -> Optional[int]:
+    async with reader(db_path) as db:
+        cur = await db.execute(
+            "SELECT image_id FROM image_sources WHERE source_key = ?",
+            (source_key,),
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        return row["image_id"] if row else None
+
+
+@_timed
+async def add_image_source(
+    image_id: int, source_key: str, db_path: str = DB_PATH
+) -> None:
+    async with writer(db_path) as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO image_sources (source_key, image_id)"
+            " VALUES (?, ?)",
+            (source_key, image_id),
+        )
+
+
+@_timed
+async def get_image_rendition(
+    image_id: int,
+    size: int,
+    load_data: bool = False,
+    db_path: str = DB_PATH,
+) -> Optional[dict]:
+    """Pick the smallest rendition at least ``size`` px, else the largest.
+
+    ``data`` is only read when Telegram has no ``file_id`` for the
+    rendition yet, or when ``load_data`` asks for it explicitly.
+    """
+    async with reader(db_path) as db:
+        cur = await db.execute(
+            "SELECT r.size, i.format, r.file_id,"
+            " CASE WHEN r.file_id IS NULL OR ? THEN r.data END AS data"
+            " FROM image_renditions r JOIN images i ON i.id = r.image_id"
+            " WHERE r.image_id = ?"
+            " ORDER BY r.size < ?,"
+            " CASE WHEN r.size >= ? THEN r.size ELSE -r.size END"
+            " LIMIT 1",
+            (load_data, image_id, size, size),
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        return dict(row) if row else None
+
+
+@_timed
+async def set_rendition_file_id(
+    image_id: int, size: int, file_id: Optional[str],
+    db_path: str = DB_PATH
+) -> None:
+    """Remember (or forget, with None) a rendition's Telegram file_id."""
+    async with writer(db_path) as db:
+        await db.execute(
+            "UPDATE image_renditions SET file_id = ?"
+            " WHERE image_id = ? AND size = ?",
+            (file_id, image_id, size),
+        )
+
+
 # Orders
-async def create_order(
+@_timed
+async def place_order(
     user_id: int,
-    artwork_name: str,
-    paper_name: str,
+    paper_id: int,
+    artwork_id: int,
     copies: int,
     sheets: int,
-    status: str,
     created_at: str,
+    username: Optional[str] = None,
+    notify: bool = True,
+    status: str = "new",
     db_path: str = DB_PATH,
-) -> int:
-    async with aiosqlite.connect(db_path) as db:
+) -> Optional[dict]:
+    """Take ``sheets`` from a paper balance and record the order atomically.
+
+    The artwork and the paper must both belong to ``user_id``, otherwise
+    None is returned. The decrement only applies while the balance covers
+    ``sheets``, so two concurrent confirmations can never drive it
+    negative. Returns ``{"order_id": ..., "quantity": ...}`` with the
+    remaining balance; on insufficient stock ``order_id`` is None,
+    ``quantity`` is what's left and nothing is written. With ``notify``
+    the atelier's notification is queued in the same transaction.
+    """
+    async with writer(db_path) as db:
+        cur = await db.execute(
+            "SELECT artwork_name FROM artworks WHERE id = ? AND user_id = ?",
+            (artwork_id, user_id),
+        )
+        art = await cur.fetchone()
+        await cur.close()
+        if art is None:
+            return None
+
+        cur = await db.execute(
+            "UPDATE paper_balance SET quantity = quantity - ?"
+            " WHERE id = ? AND user_id = ? AND quantity >= ?"
+            " RETURNING paper_name, quantity",
+            (sheets, paper_id, user_id, sheets),
+        )
+        paper = await cur.fetchone()
+        await cur.close()
+        if paper is None:
+            cur = await db.execute(
+                "SELECT quantity FROM paper_balance"
+                " WHERE id = ? AND user_id = ?",
+                (paper_id, user_id),
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            if row is None:
+                return None
+            return {"order_id": None, "quantity": row[0]}
+
         cur = await db.execute(
             "INSERT INTO orders (user_id, artwork_name, paper_name, copies,"
             " sheets, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (user_id, artwork_name, paper_name, copies, sheets, status,
-             created_at),
+            (user_id, art["artwork_name"], paper["paper_name"], copies,
+             sheets, status, created_at),
         )
-        await db.commit()
-        return cur.lastrowid
+        order_id = cur.lastrowid
+        await cur.close()
+        if notify:
+            await _add_to_outbox(db, order_id, {
+                "user_id": user_id,
+                "username": username,
+                "art_name": art["artwork_name"],
+                "paper_name": paper["paper_name"],
+                "copies": copies,
+                "sheets": sheets,
+            })
+    _invalidate_user(db_path, user_id, "papers")
+    return {"order_id": order_id, "quantity": paper["quantity"]}
+
+
+# Notification outbox
+async def _add_to_outbox(
+    db: aiosqlite.Connection, order_id: int, payload: dict
+) -> None:
+    await db.execute(
+        "INSERT INTO notification_outbox (order_id, payload,"
+        " next_attempt_at) VALUES (?, ?, ?)",
+        (order_id, json.dumps(payload, separators=(",", ":")), time.time()),
+    )
+
+
+@_timed
+async def claim_notifications(
+    limit: int, lease: float, db_path: str = DB_PATH
+) -> List[dict]:
+    """Lease up to ``limit`` due notifications for delivery.
+
+    Claimed rows are pushed ``lease`` seconds (doubled per earlier
+    attempt) into the future, so a row whose delivery never confirms is
+    picked up again once its lease runs out.
+    """
+    now = time.time()
+    async with writer(db_path) as db:
+        cur = await db.execute(
+            "UPDATE notification_outbox"
+            " SET attempts = attempts + 1,"
+            " next_attempt_at = ? + ? * (1 << MIN(attempts, 6))"
+            " WHERE id IN (SELECT id FROM notification_outbox"
+            " WHERE sent_at IS NULL AND next_attempt_at <= ?"
+            " ORDER BY next_attempt_at LIMIT ?)"
+            " RETURNING id, order_id, payload, attempts",
+            (now, lease, now, limit),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+    claimed = []
+    for row in sorted(rows, key=lambda r: r["id"]):
+        item = dict(row)
+        item["payload"] = json.loads(item["payload"])
+        claimed.append(item)
+    return claimed
+
+
+@_timed
+async def mark_notification_sent(
+    notification_id: int, db_path: str = DB_PATH
+) -> None:
+    async with writer(db_path) as db:
+        await db.execute(
+            "UPDATE notification_outbox SET sent_at = ? WHERE id = ?",
+            (time.time(), notification_id),
+        )
+
+
+# FSM states
+@_timed
+async def get_fsm_record(
+    key: str, newer_than: float = 0, db_path: str = DB_PATH
+) -> Optional[dict]:
+    """Return ``{"state", "data"}`` stored for ``key``, if still fresh."""
+    async with reader(db_path) as db:
+        cur = await db.execute(
+            "SELECT state, data FROM fsm_states"
+            " WHERE key = ? AND updated_at > ?",
+            (key, newer_than),
+        )
+        row = await cur.fetchone()
+        await cur.close()
+    if row is None:
+        return None
+    return {"state": row["state"], "data": json.loads(row["data"])}
 
 
+@_timed
+async def save_fsm_records(
+    records: Dict[str, dict], db_path: str = DB_PATH
+) -> None:
+    """Write a batch of FSM records in one transaction.
+
+    Records with neither a state nor data are deleted rather than kept.
+    """
+    now = time.time()
+    upserts = []
+    deletes = []
+    for key, record in records.items():
+        if record["state"] is None and not record["data"]:
+            deletes.append((key,))
+        else:
+            data = json.dumps(record["data"], separators=(",", ":"),
+                              ensure_ascii=False)
+            upserts.append((key, record["state"], data, now))
+    async with writer(db_path) as db:
+        if upserts:
+            await db.executemany(
+                "INSERT INTO fsm_states (key, state, data, updated_at)"
+                " VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET"
+                " state = excluded.state, data = excluded.data,"
+                " updated_at = excluded.updated_at",
+                upserts,
+            )
+        if deletes:
+            await db.executemany(
+                "DELETE FROM fsm_states WHERE key = ?", deletes)
+
+
+@_timed
+async def delete_stale_fsm_records(
+    older_than: float, db_path: str = DB_PATH
+) -> int:
+    """Drop FSM records last written before ``older_than``."""
+    async with writer(db_path) as db:
+        cur = await db.execute(
+            "DELETE FROM fsm_states WHERE updated_at <= ?", (older_than,))
+        count = cur.rowcount
+        await cur.close()
+        return count
+
+
+@_timed
 async def get_all_users(db_path: str = DB_PATH) -> List[dict]:
     """Get all users from database."""
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
+    async with reader(db_path) as db:
         cur = await db.execute(
             "SELECT user_id, username FROM users ORDER BY user_id"
         )
         rows = await cur.fetchall()
+        await cur.close()
         return [dict(row) for row in rows]
 
 
-async def search_users(query: str, db_path: str = DB_PATH) -> List[dict]:
-    """Search users by username or user_id."""
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
+@_timed
+async def load_user_index(db_path: str = DB_PATH) -> None:
+    """Fill the in-memory username index from ``db_path``."""
+    user_index.load(db_path, await get_all_users(db_path))
+
 
+@_timed
+async def search_users(query: str, db_path: str = DB_PATH) -> List[dict]:
+    """Search users by user_id, or by username prefix or substring."""
+    async with reader(db_path) as db:
         # Try to find by user_id first
         try:
             user_id = int(query)
@@ -266,16 +692,34 @@ async def search_users(query: str, db_path: str = DB_PATH) -> List[dict]:
                 (user_id,)
             )
             row = await cur.fetchone()
+            await cur.close()
             if row:
                 return [dict(row)]
         except ValueError:
             pass
 
-        # Search by username (partial match)
-        cur = await db.execute(
-            "SELECT user_id, username FROM users WHERE username LIKE ? "
-            "ORDER BY username LIMIT 10",
-            (f"%{query}%",)
-        )
+        query = query.lower()
+        if len(query) < 3:
+            # Too short for trigrams: prefix range on lower(username)
+            upper = (query[:-1] + chr(ord(query[-1]) + 1) if query
+                     else "\U0010ffff")
+            cur = await db.execute(
+                "SELECT user_id, username FROM users"
+                " WHERE lower(username) >= ? AND lower(username) < ?"
+                " ORDER BY lower(username) LIMIT ?",
+                (query, upper, SEARCH_LIMIT),
+            )
+        else:
+            # Substring match through the trigram index; prefix matches
+            # first, then closer (shorter) names
+            cur = await db.execute(
+                "SELECT users.user_id, users.username FROM users_fts"
+                " JOIN users ON users.user_id = users_fts.rowid"
+                " WHERE users_fts MATCH ?"
+                " ORDER BY instr(lower(users.username), ?) != 1,"
+                " length(users.username), users.username LIMIT ?",
+                ('"' + query.replace('"', '""') + '"', query, SEARCH_LIMIT),
+            )
         rows = await cur.fetchall()
+        await cur.close()
         return [dict(row) for row in rows]
@@ -0,0 +1,249 @@
+"""Versioned schema migrations tracked in ``PRAGMA user_version``.
+
+``MIGRATIONS[n]`` upgrades a database from version ``n`` to ``n + 1``.
+Each migration is a list of steps: plain SQL statements, or coroutines
+taking the connection for data moves SQL can't express. Append new
+entries at the end and never edit one that has shipped.
+
+Databases created before versioning was introduced start at version 0
+and re-run the first two migrations over tables that may already exist,
+so those statements must be safe to re-run (``IF NOT EXISTS`` and
+friends). Later migrations run exactly once per database: they rely on
+the ``user_version`` guard and may use non-idempotent steps such as
+``ADD COLUMN``, ``DROP COLUMN`` or ``INSERT ... SELECT``.
+"""
+
+import base64
+from typing import Awaitable, Callable, List, Union
+
+import aiosqlite
+
+Step = Union[str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+
+
+async def _move_icons_to_blobs(db: aiosqlite.Connection) -> None:
+    """Decode base64 data-URL icons from ``artworks`` into raw blobs."""
+    cur = await db.execute(
+        "SELECT id, image_icon FROM artworks WHERE image_icon IS NOT NULL"
+    )
+    rows = await cur.fetchall()
+    await cur.close()
+    icons = []
+    for artwork_id, icon in rows:
+        if icon.startswith("data:image"):
+            icon = icon.split(",", 1)[1]
+        try:
+            icons.append((artwork_id, base64.b64decode(icon)))
+        except ValueError:
+            # Unreadable icons are dropped; the artwork stays without one
+            continue
+    await db.executemany(
+        "INSERT OR IGNORE INTO artwork_icons (artwork_id, data)"
+        " VALUES (?, ?)",
+        icons,
+    )
+
+
+MIGRATIONS: List[List[Step]] = [
+    # 1: baseline schema
+    [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS paper_balance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            paper_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS artworks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            artwork_name TEXT NOT NULL,
+            image_icon TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            artwork_name TEXT NOT NULL,
+            paper_name TEXT NOT NULL,
+            copies INTEGER NOT NULL,
+            sheets INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """,
+    ],
+    # 2: secondary indexes for the per-user lookups
+    [
+        "CREATE INDEX IF NOT EXISTS idx_paper_balance_user"
+        " ON paper_balance (user_id, paper_name)",
+        "CREATE INDEX IF NOT EXISTS idx_artworks_user"
+        " ON artworks (user_id, artwork_name)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user"
+        " ON orders (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+    ],
+    # 3: artwork icons move out of the artworks row into raw JPEG blobs
+    [
+        """
+        CREATE TABLE IF NOT EXISTS artwork_icons (
+            artwork_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            FOREIGN KEY(artwork_id) REFERENCES artworks(id)
+        )
+        """,
+        _move_icons_to_blobs,
+        "ALTER TABLE artworks DROP COLUMN image_icon",
+    ],
+    # 4: remember the Telegram file_id of an uploaded icon
+    [
+        "ALTER TABLE artwork_icons ADD COLUMN file_id TEXT",
+    ],
+    # 5: images with several renditions each; existing icons become the
+    # 100px rendition of an image that reuses the artwork's id
+    [
+        """
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            format TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS image_renditions (
+            image_id INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            file_id TEXT,
+            PRIMARY KEY (image_id, size),
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )
+        """,
+        "ALTER TABLE artworks ADD COLUMN image_id INTEGER"
+        " REFERENCES images(id)",
+        "INSERT INTO images (id, format)"
+        " SELECT artwork_id, 'JPEG' FROM artwork_icons",
+        "INSERT INTO image_renditions (image_id, size, data, file_id)"
+        " SELECT artwork_id, 100, data, file_id FROM artwork_icons",
+        "UPDATE artworks SET image_id = id"
+        " WHERE id IN (SELECT artwork_id FROM artwork_icons)",
+        "DROP TABLE artwork_icons",
+    ],
+    # 6: upload fingerprints pointing at an already processed image
+    [
+        """
+        CREATE TABLE IF NOT EXISTS image_sources (
+            source_key TEXT PRIMARY KEY,
+            image_id INTEGER NOT NULL,
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )
+        """,
+    ],
+    # 7: transactional outbox for order notifications
+    [
+        """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            sent_at REAL,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending"
+        " ON notification_outbox (next_attempt_at) WHERE sent_at IS NULL",
+    ],
+    # 8: persistent FSM states for the aiogram dispatcher
+    [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated"
+        " ON fsm_states (updated_at)",
+    ],
+    # 9: trigram full-text index over usernames, kept in sync by triggers,
+    # plus a case-insensitive index for prefixes too short for trigrams
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+        "username, content='users', content_rowid='user_id',"
+        " tokenize='trigram')",
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts (rowid, username)
+            VALUES (new.user_id, new.username);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username)
+            VALUES ('delete', old.user_id, old.username);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_update
+        AFTER UPDATE OF username ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username)
+            VALUES ('delete', old.user_id, old.username);
+            INSERT INTO users_fts (rowid, username)
+            VALUES (new.user_id, new.username);
+        END
+        """,
+        "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+        "CREATE INDEX IF NOT EXISTS idx_users_username_lower"
+        " ON users (lower(username))",
+    ],
+    # 10: (user_id, id) indexes for keyset-paginated keyboards
+    [
+        "CREATE INDEX IF NOT EXISTS idx_artworks_user_page"
+        " ON artworks (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_paper_balance_user_page"
+        " ON paper_balance (user_id, id)",
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    cur = await db.execute("PRAGMA user_version")
+    (version,) = await cur.fetchone()
+    await cur.close()
+    return version
+
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """Apply pending migrations on ``db`` and return the new version.
+
+    Runs inside the caller's write transaction, so a failing migration
+    leaves both the schema and ``user_version`` untouched.
+    """
+    version = await get_schema_version(db)
+    for number in range(version, SCHEMA_VERSION):
+        for step in MIGRATIONS[number]:
+            if callable(step):
+                await step(db)
+            else:
+                await db.execute(step)
+        await db.execute(f"PRAGMA user_version = {number + 1}")
+    return max(version, SCHEMA_VERSION)
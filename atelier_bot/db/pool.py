@@ -0,0 +1,158 @@
+"""Long-lived aiosqlite connections shared by the DB helpers.
+
+Each pool keeps a fixed number of read connections plus a single writer
+connection. Reads borrow any idle reader, writes queue up in arrival order
+for the writer so only one transaction touches the file at a time.
+
+Every connection gets the same pragma profile (WAL journal, relaxed sync,
+mmap and cache sizing, busy timeout); each value can be overridden with
+the matching ``DB_*`` environment variable.
+"""
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiosqlite
+
+from atelier_bot.services.metrics import Gauge
+
+# Number of read connections kept open per database file
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Applied in order to every connection right after it is opened
+PRAGMAS = {
+    "journal_mode": os.getenv("DB_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("DB_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024))),
+    # Negative values are KiB rather than pages
+    "cache_size": int(os.getenv("DB_CACHE_SIZE", "-16000")),
+    "busy_timeout": int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")),
+    "temp_store": os.getenv("DB_TEMP_STORE", "MEMORY"),
+}
+
+DB_WRITES_WAITING = Gauge(
+    "atelier_db_writes_waiting", "Writes queued for the writer connection")
+
+
+async def apply_pragmas(db: aiosqlite.Connection) -> None:
+    for name, value in PRAGMAS.items():
+        cur = await db.execute(f"PRAGMA {name} = {value}")
+        await cur.close()
+
+
+class ConnectionPool:
+    """A fixed set of reader connections plus one serialized writer."""
+
+    def __init__(self, path: str, size: int = POOL_SIZE) -> None:
+        self.path = path
+        self.size = max(1, size)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._writer: Optional[aiosqlite.Connection] = None
+        # asyncio.Lock wakes waiters in FIFO order, so it doubles as the
+        # single-writer queue: writes run in the order they were submitted.
+        self._write_lock = asyncio.Lock()
+        self._ready = asyncio.Event()
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path)
+        db.row_factory = aiosqlite.Row
+        await apply_pragmas(db)
+        if read_only:
+            cur = await db.execute("PRAGMA query_only = ON")
+            await cur.close()
+        return db
+
+    async def open(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self._writer = await self._connect()
+        for _ in range(self.size):
+            db = await self._connect(read_only=True)
+            self._readers.append(db)
+            self._idle.put_nowait(db)
+        self._ready.set()
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow an idle read connection for the duration of the block."""
+        await self._ready.wait()
+        db = await self._idle.get()
+        try:
+            yield db
+        finally:
+            self._idle.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Hold the writer: commit on success, roll back on error."""
+        await self._ready.wait()
+        DB_WRITES_WAITING.inc()
+        try:
+            await self._write_lock.acquire()
+        finally:
+            DB_WRITES_WAITING.dec()
+        try:
+            # Take the write lock up front instead of upgrading a deferred
+            # transaction mid-way, which is what yields SQLITE_BUSY.
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+        finally:
+            self._write_lock.release()
+
+    async def close(self) -> None:
+        connections = list(self._readers)
+        if self._writer is not None:
+            connections.append(self._writer)
+        self._readers.clear()
+        self._writer = None
+        for db in connections:
+            await db.close()
+
+
+_pools: Dict[str, ConnectionPool] = {}
+
+
+async def get_pool(path: str) -> ConnectionPool:
+    """Return the pool for ``path``, opening it on first use."""
+    pool = _pools.get(path)
+    if pool is not None and pool.loop is asyncio.get_running_loop():
+        return pool
+    if pool is not None:
+        # The pool was opened on another event loop (e.g. a previous
+        # asyncio.run call); its queue and lock can't be awaited here.
+        await pool.close()
+    pool = ConnectionPool(path)
+    _pools[path] = pool
+    await pool.open()
+    return pool
+
+
+@asynccontextmanager
+async def reader(path: str) -> AsyncIterator[aiosqlite.Connection]:
+    pool = await get_pool(path)
+    async with pool.reader() as db:
+        yield db
+
+
+@asynccontextmanager
+async def writer(path: str) -> AsyncIterator[aiosqlite.Connection]:
+    pool = await get_pool(path)
+    async with pool.writer() as db:
+        yield db
+
+
+async def close_pools() -> None:
+    """Close every open pool. Called from ``main`` on shutdown."""
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        await pool.close()
@@ -0,0 +1,63 @@
+"""Sorted in-memory username index for as-you-type lookups.
+
+Inline queries arrive on every keystroke, so they are answered from a
+sorted list of lower-cased usernames searched with ``bisect`` instead of
+SQLite. ``load_user_index`` in ``db.py`` fills it at startup and
+``create_or_update_user`` keeps it current.
+"""
+
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+Entry = Tuple[str, int, str]
+
+
+class UsernameIndex:
+    def __init__(self) -> None:
+        # Database the index mirrors; writes to other files are ignored
+        self.db_path: Optional[str] = None
+        self._entries: List[Entry] = []
+        self._by_id: Dict[int, Entry] = {}
+
+    def load(self, db_path: str, users: List[dict]) -> None:
+        self.db_path = db_path
+        self._by_id = {
+            user["user_id"]: (user["username"].lower(), user["user_id"],
+                              user["username"])
+            for user in users if user["username"]
+        }
+        self._entries = sorted(self._by_id.values())
+
+    def add(self, user_id: int, username: Optional[str]) -> None:
+        """Insert or rename a user."""
+        old = self._by_id.pop(user_id, None)
+        if old is not None:
+            i = bisect.bisect_left(self._entries, old)
+            if i < len(self._entries) and self._entries[i] == old:
+                del self._entries[i]
+        if username:
+            entry = (username.lower(), user_id, username)
+            self._by_id[user_id] = entry
+            bisect.insort(self._entries, entry)
+
+    def prefix(self, query: str, limit: int) -> List[dict]:
+        """Return up to ``limit`` users whose username starts with query."""
+        query = query.lower()
+        i = bisect.bisect_left(self._entries, (query,))
+        found = []
+        for key, user_id, username in self._entries[i:i + limit]:
+            if not key.startswith(query):
+                break
+            found.append({"user_id": user_id, "username": username})
+        return found
+
+    def clear(self) -> None:
+        self.db_path = None
+        self._entries = []
+        self._by_id = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+user_index = UsernameIndex()
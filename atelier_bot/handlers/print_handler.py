@@ -1,27 +1,33 @@
-import base64
 import logging
 from datetime import datetime
+from typing import Callable, Optional
 
 from aiogram import F, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
-from aiogram.types import BufferedInputFile, CallbackQuery, Message
+from aiogram.types import (CallbackQuery, InlineKeyboardMarkup, InlineQuery,
+                           InlineQueryResultArticle, InputTextMessageContent,
+                           Message)
 
 from atelier_bot.db.db import (add_paper_for_user, create_artwork,
-                               create_or_update_user, create_order,
-                               decrement_paper)
-from atelier_bot.db.db import get_artworks_for_user
+                               create_or_update_user, get_artwork_by_id)
 from atelier_bot.db.db import get_artworks_for_user as db_get_artworks
-from atelier_bot.db.db import get_paper_by_id
+from atelier_bot.db.db import get_artworks_page, get_paper_by_id
 from atelier_bot.db.db import get_papers_for_user
 from atelier_bot.db.db import get_papers_for_user as db_get_papers
-from atelier_bot.db.db import get_user, search_users, update_paper_quantity
+from atelier_bot.db.db import (get_papers_page, get_user, place_order,
+                               search_users, update_paper_quantity)
+from atelier_bot.db.user_index import user_index
 from atelier_bot.keyboards.print_keyboards import (artworks_keyboard,
                                                    confirm_keyboard,
                                                    main_menu_keyboard,
                                                    main_reply_keyboard,
-                                                   papers_keyboard)
-from atelier_bot.services.notify import notify_atelier
+                                                   papers_keyboard,
+                                                   users_keyboard)
+from atelier_bot.services.imaging import ImageQueueFull, store_artwork_photo
+from atelier_bot.services.outbox import wake_outbox
+from atelier_bot.services.photos import PREVIEW_SIZE, send_artwork_photo
 from atelier_bot.states.order_states import OrderStates
 
 router = Router()
@@ -30,6 +36,45 @@ logger = logging.getLogger(__name__)
 
 ATELIER_ID = 144227441
 
+# Inline user search: results per answer (Telegram allows up to 50) and
+# how long Telegram may cache an answer, in seconds
+INLINE_RESULTS = 20
+INLINE_CACHE_TIME = 30
+
+
+# Bot API errors meaning the message can't be edited and a new one is due
+UNEDITABLE_ERRORS = (
+    "message can't be edited",
+    "message to edit not found",
+    "there is no text in the message to edit",
+)
+
+
+def _not_modified(e: TelegramBadRequest) -> bool:
+    """Whether the edit failed only because nothing changed (double tap)."""
+    return "message is not modified" in e.message
+
+
+async def _show(
+    callback: CallbackQuery,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> None:
+    """Turn the message behind ``callback`` into the next step.
+
+    Callback steps edit that one message instead of sending new ones; a
+    new message is sent only when it can't be edited (too old, a photo).
+    """
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if _not_modified(e):
+            return
+        if not any(error in e.message for error in UNEDITABLE_ERRORS):
+            raise
+        logger.debug("Can't edit message, sending a new one: %s", e)
+        await callback.message.answer(text, reply_markup=reply_markup)
+
 
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
@@ -70,23 +115,23 @@ async def handle_print_text(message: Message, state: FSMContext):
         await message.answer("Вы не зарегистрированы. Попробуйте /start")
         return
 
-    artworks = await get_artworks_for_user(user_id)
-    if not artworks:
+    page = await get_artworks_page(user_id)
+    if not page["items"]:
         await message.answer(
             "У вас нет доступных работ для печати. Обращайтесь в ателье."
         )
         return
 
-    papers = await get_papers_for_user(user_id)
-    if not papers:
+    if not (await get_papers_page(user_id))["items"]:
         await message.answer(
             "У вас нет бумаги на балансе. Обращайтесь в ателье."
         )
         return
 
+    # Only ids go into the state; details are looked up when needed
+    await state.set_data({})
     await state.set_state(OrderStates.choosing_artwork)
-    await state.update_data(artworks=artworks, papers=papers)
-    kb = artworks_keyboard(artworks)
+    kb = _page_keyboard(artworks_keyboard, page)
     await message.answer("Выберите работу для печати:", reply_markup=kb)
 
 
@@ -132,38 +177,41 @@ async def handle_print(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Вы не зарегистрированы. Попробуйте /start")
         return
 
-    artworks = await get_artworks_for_user(user_id)
-    if not artworks:
-        await callback.message.answer(
-            "У вас нет доступных работ для печати. Обращайтесь в ателье."
+    page = await get_artworks_page(user_id)
+    if not page["items"]:
+        await callback.answer(
+            "У вас нет доступных работ для печати. Обращайтесь в ателье.",
+            show_alert=True,
         )
         return
 
-    papers = await get_papers_for_user(user_id)
-    if not papers:
-        await callback.message.answer(
-            "У вас нет бумаги на балансе. Обращайтесь в ателье."
+    if not (await get_papers_page(user_id))["items"]:
+        await callback.answer(
+            "У вас нет бумаги на балансе. Обращайтесь в ателье.",
+            show_alert=True,
         )
         return
 
+    await callback.answer()
+    # Only ids go into the state; details are looked up when needed
+    await state.set_data({})
     await state.set_state(OrderStates.choosing_artwork)
-    await state.update_data(artworks=artworks, papers=papers)
-    kb = artworks_keyboard(artworks)
-    await callback.message.answer(
-        "Выберите работу для печати:", reply_markup=kb
-    )
+    kb = _page_keyboard(artworks_keyboard, page)
+    await _show(callback, "Выберите работу для печати:", kb)
 
 
 @router.callback_query(F.data == "add_paper")
 async def handle_add_paper(callback: CallbackQuery, state: FSMContext):
-    print(f"DEBUG: add_paper callback from user {callback.from_user.id}")
+    logger.debug("add_paper callback from user %s", callback.from_user.id)
     if callback.from_user.id != ATELIER_ID:
         await callback.answer("Эта функция только для ателье")
         return
 
+    await callback.answer()
     await state.set_state(OrderStates.atelier_adding_paper_user_id)
     await state.update_data(action="add_paper")
-    await callback.message.answer(
+    await _show(
+        callback,
         "Введите username или user_id пользователя для добавления бумаги:\n\n"
         "Примеры:\n"
         "• @username\n"
@@ -177,9 +225,11 @@ async def handle_add_art(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Эта функция только для ателье")
         return
 
+    await callback.answer()
     await state.set_state(OrderStates.atelier_adding_artwork_user_id)
     await state.update_data(action="add_art")
-    await callback.message.answer(
+    await _show(
+        callback,
         "Введите username или user_id пользователя для добавления работы:\n\n"
         "Примеры:\n"
         "• @username\n"
@@ -189,72 +239,62 @@ async def handle_add_art(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data.startswith("art_"))
 async def choose_artwork(callback: CallbackQuery, state: FSMContext):
-    print(f"DEBUG: choose_artwork called with {callback.data}")
-    # read saved state
-    data = await state.get_data()
+    logger.debug("choose_artwork called with %s", callback.data)
+    user_id = callback.from_user.id
     art_id = int(callback.data.split("_")[1])
-    artworks = data.get("artworks", [])
-    art = next((a for a in artworks if a["id"] == art_id), None)
+    art = await get_artwork_by_id(art_id, user_id)
     if not art:
         await callback.answer("Работа не найдена или устарела")
         return
 
-    print(f"DEBUG: Found artwork {art['artwork_name']}, "
-          f"has icon: {bool(art.get('image_icon'))}")
-
-    # Show artwork icon if available
-    if art.get("image_icon"):
+    await callback.answer()
+    logger.debug("Found artwork %s, has icon: %s",
+                 art["artwork_name"], bool(art.get("has_icon")))
+    await state.update_data(art_id=art["id"])
+    await state.set_state(OrderStates.choosing_paper)
 
+    # The preview photo is the only new message; the menu is edited
+    chosen = f"Выбрана работа: {art['artwork_name']}"
+    if art.get("has_icon"):
+        sent = None
         try:
-            # Remove data URL prefix if present
-            icon_b64 = art["image_icon"]
-            if icon_b64.startswith("data:image"):
-                icon_b64 = icon_b64.split(",", 1)[1]
-
-            icon_data = base64.b64decode(icon_b64)
-            icon_file = BufferedInputFile(icon_data, filename="icon.jpg")
-            print(f"DEBUG: Sending photo with {len(icon_data)} bytes")
-            await callback.message.answer_photo(
-                photo=icon_file,
-                caption=f"Выбрана работа: {art['artwork_name']}"
+            logger.debug("Sending artwork photo")
+            sent = await send_artwork_photo(
+                callback.bot, callback.message.chat.id, art,
+                caption=chosen, size=PREVIEW_SIZE,
             )
-            print("DEBUG: Photo sent successfully")
         except Exception as e:
-            print(f"DEBUG: Error sending artwork icon: {e}")
             logger.error("Error sending artwork icon: %s", e)
-            await callback.message.answer(
-                f"Выбрана работа: {art['artwork_name']} (иконка недоступна)")
-    else:
-        print("DEBUG: No icon, sending text only")
-        await callback.message.answer(f"Выбрана работа: {art['artwork_name']}")
+        if not sent:
+            chosen += " (иконка недоступна)"
 
-    await state.update_data(chosen_art=art)
-    await state.set_state(OrderStates.choosing_paper)
-    kb = papers_keyboard(data.get("papers", []))
-    await callback.message.answer("Выберите бумагу:", reply_markup=kb)
+    kb = _page_keyboard(papers_keyboard, await get_papers_page(user_id))
+    await _show(callback, f"{chosen}\n\nВыберите бумагу:", kb)
 
 
 @router.callback_query(F.data == "cancel")
 async def cancel_action(callback: CallbackQuery, state: FSMContext):
     """Cancel current action and return to main menu."""
+    await callback.answer("Действие отменено")
     await state.clear()
-    is_atelier = callback.from_user.id == ATELIER_ID
-    kb = main_menu_keyboard(is_atelier)
-    reply_kb = main_reply_keyboard(is_atelier)
-    await callback.message.answer("Действие отменено.", reply_markup=reply_kb)
-    await callback.message.answer("Выберите действие:", reply_markup=kb)
+    # The reply keyboard from /start stays; only the menu is restored
+    kb = main_menu_keyboard(callback.from_user.id == ATELIER_ID)
+    await _show(callback, "Действие отменено. Выберите действие:", kb)
 
 
 @router.callback_query(F.data.startswith("paper_"))
 async def choose_paper(callback: CallbackQuery, state: FSMContext):
     paper_id = int(callback.data.split("_")[1])
     paper = await get_paper_by_id(paper_id)
-    if not paper:
+    if not paper or paper["user_id"] != callback.from_user.id:
         await callback.answer("Бумага не найдена")
         return
-    await state.update_data(chosen_paper=paper)
+    await callback.answer()
+    await state.update_data(paper_id=paper["id"])
     await state.set_state(OrderStates.entering_copies)
-    await callback.message.answer(
+    await _show(
+        callback,
+        f"Бумага: {paper['paper_name']}\n\n"
         "Введите количество копий для печати (число):"
     )
 
@@ -262,16 +302,63 @@ async def choose_paper(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "back_to_artworks")
 async def back_to_artworks(callback: CallbackQuery, state: FSMContext):
     """Return to artwork selection during the print flow."""
-    data = await state.get_data()
-    artworks = data.get("artworks") or []
-    if not artworks:
+    page = await get_artworks_page(callback.from_user.id)
+    if not page["items"]:
         await callback.answer("Нет доступных работ")
         return
+    await callback.answer()
     await state.set_state(OrderStates.choosing_artwork)
-    kb = artworks_keyboard(artworks)
-    await callback.message.answer(
-        "Выберите работу:", reply_markup=kb
-    )
+    kb = _page_keyboard(artworks_keyboard, page)
+    await _show(callback, "Выберите работу:", kb)
+
+
+def _page_keyboard(
+    build: Callable[..., InlineKeyboardMarkup], page: dict
+) -> InlineKeyboardMarkup:
+    return build(page["items"], page["has_prev"], page["has_next"])
+
+
+def _page_args(callback_data: str) -> dict:
+    """Turn ``<list>_next_<id>`` / ``<list>_prev_<id>`` into query args."""
+    _, direction, item_id = callback_data.split("_")
+    if direction == "prev":
+        return {"before_id": int(item_id)}
+    return {"after_id": int(item_id)}
+
+
+async def _edit_markup(
+    callback: CallbackQuery, reply_markup: InlineKeyboardMarkup
+) -> None:
+    """Swap the keyboard of the callback's message; double taps are no-ops."""
+    try:
+        await callback.message.edit_reply_markup(reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if not _not_modified(e):
+            raise
+
+
+@router.callback_query(F.data.startswith("arts_"))
+async def page_artworks(callback: CallbackQuery):
+    """Show another page of artworks in the same message."""
+    page = await get_artworks_page(
+        callback.from_user.id, **_page_args(callback.data))
+    if not page["items"]:
+        await callback.answer("Нет доступных работ")
+        return
+    await callback.answer()
+    await _edit_markup(callback, _page_keyboard(artworks_keyboard, page))
+
+
+@router.callback_query(F.data.startswith("papers_"))
+async def page_papers(callback: CallbackQuery):
+    """Show another page of paper balances in the same message."""
+    page = await get_papers_page(
+        callback.from_user.id, **_page_args(callback.data))
+    if not page["items"]:
+        await callback.answer("Бумага не найдена")
+        return
+    await callback.answer()
+    await _edit_markup(callback, _page_keyboard(papers_keyboard, page))
 
 
 @router.message(OrderStates.entering_copies)
@@ -304,11 +391,18 @@ async def enter_sheets(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, введите корректное число")
         return
     sheets = int(text)
-    data = await state.get_data()
-    paper = data.get("chosen_paper")
     if sheets <= 0:
         await message.answer("Количество должно быть больше нуля")
         return
+    data = await state.get_data()
+    user_id = message.from_user.id
+    art = await get_artwork_by_id(data.get("art_id") or 0, user_id)
+    paper = await get_paper_by_id(data.get("paper_id") or 0)
+    if not art or not paper or paper["user_id"] != user_id:
+        await state.clear()
+        await message.answer("Заказ устарел, начните заново")
+        return
+    # Early feedback only; place_order re-checks the balance atomically
     if sheets > paper["quantity"]:
         await message.answer(
             f"Недостаточно бумаги. Доступно: {paper['quantity']}"
@@ -317,7 +411,6 @@ async def enter_sheets(message: Message, state: FSMContext):
     await state.update_data(sheets=sheets)
     await state.set_state(OrderStates.confirming)
 
-    art = data.get("chosen_art")
     copies = data.get("copies")
     confirm_text = (
         f"Подтвердите заказ:\n\n"
@@ -334,33 +427,38 @@ async def enter_sheets(message: Message, state: FSMContext):
 async def confirm_order(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     user_id = callback.from_user.id
-    art = data.get("chosen_art")
-    paper = data.get("chosen_paper")
     copies = data.get("copies")
     sheets = data.get("sheets")
-    # perform DB updates
-    await decrement_paper(paper["id"], sheets)
+    # decrement paper, store the order and its notification in one go
     now = datetime.utcnow().isoformat()
-    await create_order(
-        user_id=user_id,
-        artwork_name=art["artwork_name"],
-        paper_name=paper["paper_name"],
-        copies=copies,
-        sheets=sheets,
-        status="new",
-        created_at=now,
-    )
-    # notify atelier
-    await notify_atelier(
-        user_id=user_id,
-        username=callback.from_user.username,
-        art_name=art["artwork_name"],
-        paper_name=paper["paper_name"],
-        copies=copies,
-        sheets=sheets,
-    )
-    await callback.message.answer("Заказ принят и отправлен в ателье 🖨️")
+    result = None
+    if copies and sheets:
+        result = await place_order(
+            user_id=user_id,
+            paper_id=data.get("paper_id") or 0,
+            artwork_id=data.get("art_id") or 0,
+            copies=copies,
+            sheets=sheets,
+            created_at=now,
+            username=callback.from_user.username,
+        )
+    if result is None:
+        await callback.answer("Заказ уже оформлен или устарел")
+        return
+    await callback.answer()
+    if result["order_id"] is None:
+        await state.set_state(OrderStates.entering_sheets)
+        await _show(
+            callback,
+            f"Недостаточно бумаги. Доступно: {result['quantity']}\n"
+            "Введите количество листов бумаги для печати (число):"
+        )
+        return
+    # notify atelier in the background
+    wake_outbox()
     await state.clear()
+    # Editing drops the buttons, so the order can't be confirmed twice
+    await _show(callback, "Заказ принят и отправлен в ателье 🖨️")
 
 
 # Atelier workflow handlers
@@ -400,8 +498,8 @@ async def atelier_enter_artwork_user(message: Message, state: FSMContext):
         await message.answer(
             f"Найдено несколько пользователей по запросу "
             f"'{message.text.strip()}'.\n"
-            "Пожалуйста, введите более точный username или "
-            "используйте user_id."
+            "Выберите пользователя или введите более точный username:",
+            reply_markup=users_keyboard(users),
         )
         return
 
@@ -412,8 +510,8 @@ async def atelier_enter_artwork_user(message: Message, state: FSMContext):
 
 @router.message(OrderStates.atelier_adding_paper_user_id)
 async def atelier_enter_paper_user(message: Message, state: FSMContext):
-    print(f"DEBUG: Received message in atelier_adding_paper_user_id: "
-          f"{message.text}")
+    logger.debug("Received message in atelier_adding_paper_user_id: %s",
+                 message.text)
     if not message.text:
         await message.answer("Пожалуйста, введите username или user_id")
         return
@@ -448,8 +546,8 @@ async def atelier_enter_paper_user(message: Message, state: FSMContext):
         await message.answer(
             f"Найдено несколько пользователей по запросу "
             f"'{message.text.strip()}'.\n"
-            "Пожалуйста, введите более точный username или "
-            "используйте user_id."
+            "Выберите пользователя или введите более точный username:",
+            reply_markup=users_keyboard(users),
         )
         return
 
@@ -496,25 +594,25 @@ async def atelier_enter_artwork_name(message: Message, state: FSMContext):
 @router.message(OrderStates.atelier_adding_artwork_image, F.photo)
 async def atelier_receive_artwork_image(message: Message, state: FSMContext):
     """Handle artwork image upload and create icon."""
-    from atelier_bot.db.db import create_artwork_icon
-
-    # Get the largest photo size
-    photo = message.photo[-1]
-
-    # Download the photo
-    photo_file = await message.bot.download(photo.file_id)
-    photo_data = photo_file.read()
-
-    # Create icon
-    icon_base64 = create_artwork_icon(photo_data)
+    # Process the photo in the image pool, or reuse a known one
+    try:
+        image_id = await store_artwork_photo(message.bot, message.photo)
+    except ImageQueueFull:
+        await message.answer(
+            "⏳ Сейчас обрабатывается слишком много изображений. "
+            "Отправьте фото ещё раз через минуту "
+            "(или /skip чтобы добавить работу без иконки).")
+        return
+    except Exception as e:
+        logger.error("Error creating artwork icon: %s", e)
+        image_id = None
 
-    if icon_base64:
+    if image_id:
         await message.answer("✅ Иконка создана! Добавляю работу...")
     else:
         await message.answer(
             "⚠️ Не удалось создать иконку, но работа будет "
             "добавлена без иконки.")
-        icon_base64 = None
 
     # Get data and create artwork
     data = await state.get_data()
@@ -522,7 +620,7 @@ async def atelier_receive_artwork_image(message: Message, state: FSMContext):
     artwork_name = data.get("atelier_artwork_name")
 
     try:
-        await create_artwork(user_id, artwork_name, icon_base64)
+        await create_artwork(user_id, artwork_name, image_id)
         await message.answer(
             f"✅ Работа '{artwork_name}' добавлена для пользователя "
             f"ID: {user_id}")
@@ -754,4 +852,47 @@ async def cmd_cancel(message: Message, state: FSMContext):
         await message.answer("Нет активных действий для отмены")
 
 
+@router.callback_query(F.data.startswith("user_"))
+async def choose_user(callback: CallbackQuery, state: FSMContext):
+    """Pick a user from the keyboard shown when a search was ambiguous."""
+    user_id = int(callback.data.split("_")[1])
+    current_state = await state.get_state()
+    if current_state == OrderStates.atelier_adding_artwork_user_id.state:
+        await state.update_data(atelier_artwork_user_id=user_id)
+        await state.set_state(OrderStates.atelier_adding_artwork_name)
+        await _show(callback, "Введите название работы:")
+    elif current_state == OrderStates.atelier_adding_paper_user_id.state:
+        await state.update_data(atelier_paper_user_id=user_id)
+        await state.set_state(OrderStates.atelier_adding_paper_name)
+        await _show(callback, "Введите название бумаги:")
+    else:
+        await callback.answer("Действие устарело")
+        return
+    await callback.answer()
+
+
 # Inline query handler for user search
+@router.inline_query()
+async def inline_user_search(inline_query: InlineQuery):
+    """Suggest users by username prefix as the atelier types.
+
+    Served from the in-memory username index. Picking a result sends the
+    user_id, which the "add artwork/paper" steps resolve exactly.
+    """
+    if inline_query.from_user.id != ATELIER_ID:
+        await inline_query.answer(
+            [], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+    query = inline_query.query.strip().lstrip("@")
+    results = [
+        InlineQueryResultArticle(
+            id=str(user["user_id"]),
+            title=f"@{user['username']}",
+            description=f"ID: {user['user_id']}",
+            input_message_content=InputTextMessageContent(
+                message_text=str(user["user_id"])),
+        )
+        for user in user_index.prefix(query, INLINE_RESULTS)
+    ]
+    await inline_query.answer(
+        results, cache_time=INLINE_CACHE_TIME, is_personal=True)
@@ -1,96 +1,149 @@
-from typing import List
+"""Inline and reply keyboards of the print and atelier flows.
+
+The rows of the static keyboards are built once per role and the buttons
+of the dynamic ones are cached by their contents. Shared buttons are
+frozen and every call returns a markup with its own row lists, so a
+caller changing its keyboard can't change anyone else's.
+"""
+
+from functools import lru_cache
+from typing import List, Sequence, Tuple
 
 from aiogram.types import (InlineKeyboardButton, InlineKeyboardMarkup,
                            KeyboardButton, ReplyKeyboardMarkup)
+from pydantic import ConfigDict
+
+# Buttons shown for every page of the same artwork or paper are reused
+BUTTON_CACHE_SIZE = 1024
+
+
+class _SharedButton(InlineKeyboardButton):
+    """Inline button reused across keyboards; assigning to it raises."""
+
+    model_config = ConfigDict(frozen=True)
+
+
+class _SharedReplyButton(KeyboardButton):
+    """Reply button reused across keyboards; assigning to it raises."""
+
+    model_config = ConfigDict(frozen=True)
+
+
+CANCEL_BUTTON = _SharedButton(text="Отмена", callback_data="cancel")
+BACK_BUTTON = _SharedButton(text="Назад", callback_data="back_to_artworks")
+
+
+def _inline(rows: Sequence[Sequence[InlineKeyboardButton]]
+            ) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[list(row) for row in rows])
+
+
+@lru_cache(maxsize=None)
+def _main_menu_rows(is_atelier: bool) -> Tuple[Tuple[_SharedButton, ...], ...]:
+    if not is_atelier:
+        return ((_SharedButton(text="🖨 Печать", callback_data="print"),),)
+    return ((
+        _SharedButton(text="➕ Добавить работу", callback_data="add_art"),
+        _SharedButton(text="➕ Добавить бумагу", callback_data="add_paper"),
+    ),)
 
 
 def main_menu_keyboard(is_atelier: bool) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardMarkup(inline_keyboard=[])
+    return _inline(_main_menu_rows(is_atelier))
+
+
+@lru_cache(maxsize=None)
+def _main_reply_rows(
+    is_atelier: bool
+) -> Tuple[Tuple[_SharedReplyButton, ...], ...]:
     if not is_atelier:
-        kb.inline_keyboard.append(
-            [InlineKeyboardButton(text="🖨 Печать", callback_data="print")]
-        )
-    else:
-        kb.inline_keyboard.append([
-            InlineKeyboardButton(
-                text="➕ Добавить работу", callback_data="add_art"),
-            InlineKeyboardButton(
-                text="➕ Добавить бумагу", callback_data="add_paper")
-        ])
-    return kb
+        # Keyboard for artists
+        return ((_SharedReplyButton(text="🖨 Печать"),),)
+    # Keyboard for atelier
+    return ((
+        _SharedReplyButton(text="➕ Добавить работу"),
+        _SharedReplyButton(text="➕ Добавить бумагу"),
+    ),)
 
 
 def main_reply_keyboard(is_atelier: bool) -> ReplyKeyboardMarkup:
     """Create persistent reply keyboard for main menu."""
-    kb = ReplyKeyboardMarkup(
-        keyboard=[],
+    return ReplyKeyboardMarkup(
+        keyboard=[list(row) for row in _main_reply_rows(is_atelier)],
         resize_keyboard=True,
         one_time_keyboard=False,
         persistent=True
     )
 
-    if not is_atelier:
-        # Keyboard for artists
-        kb.keyboard.append([
-            KeyboardButton(text="🖨 Печать")
-        ])
-    else:
-        # Keyboard for atelier
-        kb.keyboard.append([
-            KeyboardButton(text="➕ Добавить работу"),
-            KeyboardButton(text="➕ Добавить бумагу")
-        ])
 
-    return kb
+def _page_row(
+    prefix: str, items: List[dict], has_prev: bool, has_next: bool
+) -> List[InlineKeyboardButton]:
+    """Previous/next buttons keyed by the first and last id on the page."""
+    row = []
+    if has_prev and items:
+        row.append(InlineKeyboardButton(
+            text="◀️", callback_data=f"{prefix}_prev_{items[0]['id']}"))
+    if has_next and items:
+        row.append(InlineKeyboardButton(
+            text="▶️", callback_data=f"{prefix}_next_{items[-1]['id']}"))
+    return row
+
+
+@lru_cache(maxsize=BUTTON_CACHE_SIZE)
+def _artwork_button(
+    artwork_id: int, name: str, has_icon: bool
+) -> _SharedButton:
+    icon_indicator = "🖼️ " if has_icon else ""
+    return _SharedButton(
+        text=f"{icon_indicator}{name}", callback_data=f"art_{artwork_id}")
+
+
+@lru_cache(maxsize=BUTTON_CACHE_SIZE)
+def _paper_button(
+    paper_id: int, name: str, quantity: int
+) -> _SharedButton:
+    return _SharedButton(
+        text=f"{name} ({quantity})", callback_data=f"paper_{paper_id}")
 
 
-def artworks_keyboard(artworks: List[dict]) -> InlineKeyboardMarkup:
+def artworks_keyboard(
+    artworks: List[dict], has_prev: bool = False, has_next: bool = False
+) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup(inline_keyboard=[])
     for a in artworks:
-        icon_indicator = "🖼️ " if a.get("image_icon") else ""
-        kb.inline_keyboard.append(
-            [
-                InlineKeyboardButton(
-                    text=f"{icon_indicator}{a['artwork_name']}",
-                    callback_data=f"art_{a['id']}",
-                )
-            ]
-        )
-    kb.inline_keyboard.append([
-        InlineKeyboardButton(text="Отмена", callback_data="cancel")
-    ])
+        kb.inline_keyboard.append([_artwork_button(
+            a["id"], a["artwork_name"], bool(a.get("has_icon")))])
+    nav = _page_row("arts", artworks, has_prev, has_next)
+    if nav:
+        kb.inline_keyboard.append(nav)
+    kb.inline_keyboard.append([CANCEL_BUTTON])
     return kb
 
 
-def papers_keyboard(papers: List[dict]) -> InlineKeyboardMarkup:
+def papers_keyboard(
+    papers: List[dict], has_prev: bool = False, has_next: bool = False
+) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup(inline_keyboard=[])
     for p in papers:
-        label = f"{p['paper_name']} ({p['quantity']})"
-        kb.inline_keyboard.append(
-            [
-                InlineKeyboardButton(
-                    text=label, callback_data=f"paper_{p['id']}",
-                )
-            ]
-        )
-    kb.inline_keyboard.append([
-        InlineKeyboardButton(text="Назад", callback_data="back_to_artworks"),
-        InlineKeyboardButton(text="Отмена", callback_data="cancel"),
-    ])
+        # The quantity is part of the key, so a new balance gets a new label
+        kb.inline_keyboard.append([_paper_button(
+            p["id"], p["paper_name"], p["quantity"])])
+    nav = _page_row("papers", papers, has_prev, has_next)
+    if nav:
+        kb.inline_keyboard.append(nav)
+    kb.inline_keyboard.append([BACK_BUTTON, CANCEL_BUTTON])
     return kb
 
 
+_CONFIRM_ROWS = ((
+    _SharedButton(text="✅ Подтвердить", callback_data="confirm_order"),
+    CANCEL_BUTTON,
+),)
+
+
 def confirm_keyboard() -> InlineKeyboardMarkup:
-    kb = InlineKeyboardMarkup(inline_keyboard=[])
-    kb.inline_keyboard.append(
-        [
-            InlineKeyboardButton(
-                text="✅ Подтвердить", callback_data="confirm_order"
-            ),
-            InlineKeyboardButton(text="Отмена", callback_data="cancel"),
-        ]
-    )
-    return kb
+    return _inline(_CONFIRM_ROWS)
 
 
 def users_keyboard(users: List[dict]) -> InlineKeyboardMarkup:
@@ -107,7 +160,5 @@ def users_keyboard(users: List[dict]) -> InlineKeyboardMarkup:
                 )
             ]
         )
-    kb.inline_keyboard.append([
-        InlineKeyboardButton(text="Отмена", callback_data="cancel")
-    ])
+    kb.inline_keyboard.append([CANCEL_BUTTON])
     return kb
@@ -0,0 +1,103 @@
+"""Structured, non-blocking logging.
+
+Records are formatted as one JSON object per line (or plain text with
+``LOG_FORMAT=text``) and put on an in-memory queue; a ``QueueListener``
+thread writes them to stderr, so the event loop never waits on terminal or
+pipe I/O. DEBUG records are sampled: only every ``LOG_DEBUG_SAMPLE``-th
+record of each message template is kept.
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# aiogram logs every handled update at INFO
+LOG_AIOGRAM_LEVEL = os.getenv("LOG_AIOGRAM_LEVEL", "WARNING").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_DEBUG_SAMPLE = int(os.getenv("LOG_DEBUG_SAMPLE", "10"))
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_ATTRS = set(vars(logging.LogRecord(
+    "", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(
+                record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """Keep one in ``every`` DEBUG records per message template."""
+
+    def __init__(self, every: int = LOG_DEBUG_SAMPLE) -> None:
+        super().__init__()
+        self.every = max(1, every)
+        self._seen: Dict[Tuple[str, str], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.DEBUG:
+            return True
+        key = (record.name, str(record.msg))
+        seen = self._seen.get(key, 0)
+        self._seen[key] = seen + 1
+        return seen % self.every == 0
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(
+    level: str = LOG_LEVEL,
+    fmt: str = LOG_FORMAT,
+    debug_sample: int = LOG_DEBUG_SAMPLE,
+) -> None:
+    """Route the root logger through a queue to a background writer."""
+    global _listener
+    stop_logging()
+
+    # Records are formatted on the caller's side; the listener only writes
+    handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(DebugSampler(debug_sample))
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    _listener = logging.handlers.QueueListener(handler.queue, stream)
+    _listener.start()
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    logging.getLogger("aiogram").setLevel(LOG_AIOGRAM_LEVEL)
+
+
+def stop_logging() -> None:
+    """Write out queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,10 +1,11 @@
+import argparse
 import asyncio
 import os
 
 #
 """Entry point for the atelier_bot package.
 
-Run with: python -m atelier_bot.main
+Run with: python -m atelier_bot.main [--mode polling|webhook]
 """
 
 import logging
@@ -12,37 +13,105 @@ import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import SimpleEventIsolation
 
-from atelier_bot.db.db import init_db
+from atelier_bot.db.db import init_db, load_user_index
+from atelier_bot.db.pool import close_pools
 from atelier_bot.handlers.print_handler import router as print_router
+from atelier_bot.logging_setup import setup_logging, stop_logging
+from atelier_bot.middlewares.concurrency import ConcurrencyMiddleware
+from atelier_bot.middlewares.timing import (HandlerMetricsMiddleware,
+                                            UpdateMetricsMiddleware)
+from atelier_bot.services.delivery import stop_delivery_queue
+from atelier_bot.services.fsm_storage import SQLiteStorage
+from atelier_bot.services.imaging import shutdown_image_executor
+from atelier_bot.services.metrics import (start_metrics_server,
+                                          stop_metrics_server)
+from atelier_bot.services.notify import close_notify_bot
+from atelier_bot.services.outbox import (start_outbox_dispatcher,
+                                         stop_outbox_dispatcher)
+from atelier_bot.services.telegram_api import create_session
+from atelier_bot.webhook import run_webhook
 
 # This module is intended to be run as a module:
 # python -m atelier_bot.main
 
+logger = logging.getLogger(__name__)
 
-logging.basicConfig(level=logging.DEBUG)
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Atelier Cauchemar bot")
+    parser.add_argument(
+        "--mode", choices=("polling", "webhook"),
+        default=os.getenv("BOT_MODE", "polling"),
+        help="receive updates by long polling or via a webhook server",
+    )
+    return parser.parse_args()
+
+
+def create_dispatcher(storage: BaseStorage) -> Dispatcher:
+    """Build the dispatcher and its middlewares; routers are added after."""
+    # aiogram's FSM middleware reads the state before any middleware added
+    # here runs, so the per-user lock must come from its event isolation:
+    # the next update of a user is routed only after the previous one ends
+    dp = Dispatcher(storage=storage, events_isolation=SimpleEventIsolation())
+    dp.update.outer_middleware(ConcurrencyMiddleware())
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    # Inner middlewares on the dispatcher apply to every router below it
+    handler_metrics = HandlerMetricsMiddleware()
+    for event_name, observer in dp.observers.items():
+        if event_name != "update":
+            observer.middleware(handler_metrics)
+    return dp
 
 
-async def main() -> None:
+async def run_polling(bot: Bot, dp: Dispatcher) -> None:
+    """Poll for updates, dropping a webhook left by an earlier run."""
+    # getUpdates is refused while a webhook is set; pending updates are kept
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
+
+async def main(mode: str = "polling") -> None:
     token = os.getenv("BOT_TOKEN")
     if not token:
         raise RuntimeError("BOT_TOKEN environment variable is required")
 
     await init_db()
+    await load_user_index()
 
     bot = Bot(
         token=token,
+        session=create_session(),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
-    dp = Dispatcher()
+    storage = SQLiteStorage()
+    dp = create_dispatcher(storage)
     dp.include_router(print_router)
+    start_outbox_dispatcher(bot)
+    await start_metrics_server()
 
     try:
-        print("Bot started")
-        await dp.start_polling(bot)
+        logger.info("Bot started in %s mode", mode)
+        if mode == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await run_polling(bot, dp)
     finally:
+        await stop_outbox_dispatcher()
+        await stop_delivery_queue()
+        await storage.close()
         await bot.session.close()
+        await close_notify_bot()
+        await close_pools()
+        shutdown_image_executor()
+        await stop_metrics_server()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    setup_logging()
+    try:
+        asyncio.run(main(parse_args().mode))
+    finally:
+        stop_logging()
@@ -0,0 +1,114 @@
+"""Bounded, per-user ordered update processing.
+
+The dispatcher starts a task per update, so a burst of uploads or /start
+presses would otherwise run an unlimited number of handlers at once, each
+holding SQLite connections and image work. This outer middleware lets at
+most ``MAX_CONCURRENT_UPDATES`` handlers run, processes one user's updates
+one at a time so a busy user can't hold several slots, and drops updates
+once ``MAX_PENDING_UPDATES`` are already waiting.
+
+aiogram's FSM middleware runs before this one and reads the state on its
+own, so keeping FSM routing consistent is left to the dispatcher's event
+isolation (see ``main.create_dispatcher``).
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from atelier_bot.services.metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "100"))
+
+UPDATES_IN_FLIGHT = Gauge(
+    "atelier_updates_in_flight", "Updates currently being handled")
+UPDATES_WAITING = Gauge(
+    "atelier_updates_waiting", "Updates queued for a handler slot")
+UPDATES_SHED = Counter(
+    "atelier_updates_shed_total", "Updates dropped because of overload")
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+
+class _UserLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class ConcurrencyMiddleware(BaseMiddleware):
+    """Outer update middleware limiting and ordering handler execution."""
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_UPDATES,
+        max_pending: int = MAX_PENDING_UPDATES,
+    ) -> None:
+        self.max_pending = max_pending
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._user_locks: Dict[int, _UserLock] = {}
+
+    async def __call__(
+        self,
+        handler: Handler,
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self.waiting >= self.max_pending:
+            UPDATES_SHED.inc()
+            logger.warning("Dropping update, %s already waiting",
+                           self.waiting)
+            return None
+
+        user: Optional[User] = data.get("event_from_user")
+        if user is None:
+            return await self._run(handler, event, data, asyncio.Lock())
+
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = _UserLock()
+        entry.users += 1
+        try:
+            return await self._run(handler, event, data, entry.lock)
+        finally:
+            entry.users -= 1
+            if not entry.users:
+                del self._user_locks[user.id]
+
+    async def _run(
+        self,
+        handler: Handler,
+        event: TelegramObject,
+        data: Dict[str, Any],
+        user_lock: asyncio.Lock,
+    ) -> Any:
+        self._set_waiting(1)
+        waiting = True
+        try:
+            # Take the user's turn first so queued updates of one busy user
+            # don't sit on global slots
+            async with user_lock, self._slots:
+                self._set_waiting(-1)
+                waiting = False
+                UPDATES_IN_FLIGHT.inc()
+                try:
+                    return await handler(event, data)
+                finally:
+                    UPDATES_IN_FLIGHT.dec()
+        finally:
+            if waiting:
+                self._set_waiting(-1)
+
+    def _set_waiting(self, delta: int) -> None:
+        self.waiting += delta
+        UPDATES_WAITING.set(self.waiting)
@@ -0,0 +1,62 @@
+"""Latency and error metrics for updates and handlers.
+
+``UpdateMetricsMiddleware`` is an outer update middleware and times each
+update by type (message, callback_query, ...). ``HandlerMetricsMiddleware``
+is registered as an inner middleware on the dispatcher's observers, which
+child routers inherit, and times each handler by function name.
+"""
+
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from atelier_bot.services.metrics import Counter, Histogram
+
+UPDATE_SECONDS = Histogram(
+    "atelier_update_seconds", "Time to process an update", ("type",))
+HANDLER_SECONDS = Histogram(
+    "atelier_handler_seconds", "Time spent in a handler", ("handler",))
+HANDLER_ERRORS = Counter(
+    "atelier_handler_errors_total", "Handlers that raised", ("handler",))
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Handler,
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        update_type = (event.event_type if isinstance(event, Update)
+                       else type(event).__name__)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - start,
+                                   type=update_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Handler,
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None),
+                       "__name__", "unknown")
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start,
+                                    handler=name)
@@ -0,0 +1,154 @@
+"""Background delivery of outbound Telegram messages.
+
+Handlers hand a send coroutine to ``DeliveryQueue.submit`` and return at
+once; a worker task sends it later. Each chat has its own token bucket so
+bursts stay under Telegram's per-chat flood limits, ``TelegramRetryAfter``
+is honoured, and network or server errors are retried with exponential
+backoff.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram.exceptions import (TelegramNetworkError, TelegramRetryAfter,
+                                TelegramServerError)
+
+logger = logging.getLogger(__name__)
+
+# Sustained messages per second and burst size allowed for a single chat
+DELIVERY_RATE = float(os.getenv("DELIVERY_RATE", "1"))
+DELIVERY_BURST = int(os.getenv("DELIVERY_BURST", "3"))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "5"))
+# Backoff starts here and doubles per attempt, up to DELIVERY_MAX_DELAY
+DELIVERY_BASE_DELAY = float(os.getenv("DELIVERY_BASE_DELAY", "1"))
+DELIVERY_MAX_DELAY = float(os.getenv("DELIVERY_MAX_DELAY", "60"))
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class TokenBucket:
+    """Classic token bucket; ``reserve`` returns how long to wait."""
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Take the token now, even if that goes negative, so concurrent
+        # callers queue up behind each other instead of all waking at once
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class DeliveryQueue:
+    """Rate-limited, retrying sender fed by an in-memory queue."""
+
+    def __init__(
+        self,
+        rate: float = DELIVERY_RATE,
+        burst: int = DELIVERY_BURST,
+        max_attempts: int = DELIVERY_MAX_ATTEMPTS,
+        base_delay: float = DELIVERY_BASE_DELAY,
+        max_delay: float = DELIVERY_MAX_DELAY,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._queue: "asyncio.Queue[Tuple[int, Job]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    def submit(self, chat_id: int, job: Job) -> None:
+        """Queue ``job`` for ``chat_id`` and start the worker if needed."""
+        self._queue.put_nowait((chat_id, job))
+        if self._worker is None or self._worker.done():
+            self.loop = asyncio.get_running_loop()
+            self._worker = asyncio.create_task(self._run())
+
+    async def deliver(self, chat_id: int, job: Job) -> Any:
+        """Run ``job`` under the chat's rate limit, retrying on failure."""
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(
+                self.rate, self.burst)
+        for attempt in range(1, self.max_attempts + 1):
+            await asyncio.sleep(bucket.reserve())
+            try:
+                return await job()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_attempts:
+                    raise
+                delay = e.retry_after
+            except (TelegramNetworkError, TelegramServerError):
+                if attempt == self.max_attempts:
+                    raise
+                delay = min(self.max_delay,
+                            self.base_delay * 2 ** (attempt - 1))
+            logger.warning("Delivery to chat %s failed (attempt %s/%s), "
+                           "retrying in %.1fs", chat_id, attempt,
+                           self.max_attempts, delay)
+            await asyncio.sleep(delay)
+
+    async def _run(self) -> None:
+        while True:
+            chat_id, job = await self._queue.get()
+            try:
+                await self.deliver(chat_id, job)
+            except Exception as e:
+                logger.error("Giving up delivery to chat %s: %s", chat_id, e)
+            finally:
+                self._queue.task_done()
+
+    async def join(self) -> None:
+        """Wait until everything submitted so far has been handled."""
+        await self._queue.join()
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Flush pending deliveries (up to ``timeout``), then stop."""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %s undelivered messages on shutdown",
+                           self._queue.qsize())
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+
+_queue: Optional[DeliveryQueue] = None
+
+
+def get_delivery_queue() -> DeliveryQueue:
+    global _queue
+    if _queue is None or _queue.loop not in (
+        None, asyncio.get_running_loop()
+    ):
+        _queue = DeliveryQueue()
+    return _queue
+
+
+async def stop_delivery_queue() -> None:
+    """Flush and stop the shared queue. Called from ``main`` on shutdown."""
+    global _queue
+    if _queue is not None:
+        await _queue.stop()
+        _queue = None
@@ -0,0 +1,138 @@
+"""SQLite-backed FSM storage for the aiogram dispatcher.
+
+States and their data live in the ``fsm_states`` table of the bot's
+database, so print and atelier flows in progress survive restarts and
+deploys. Writes are buffered in memory and flushed together in one
+transaction every ``FSM_FLUSH_INTERVAL`` seconds; reads see buffered
+writes first. Only unflushed changes are held in RAM. States untouched
+for ``FSM_STATE_TTL`` seconds count as abandoned and are purged.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from atelier_bot.db.db import (DB_PATH, delete_stale_fsm_records,
+                               get_fsm_record, save_fsm_records)
+
+logger = logging.getLogger(__name__)
+
+# Seconds buffered writes may wait before they reach SQLite
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+# Seconds of inactivity after which a state is dropped (default a week)
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))
+FSM_PURGE_INTERVAL = float(os.getenv("FSM_PURGE_INTERVAL", "3600"))
+
+
+class SQLiteStorage(BaseStorage):
+    """Write-behind ``BaseStorage`` on top of the connection pool."""
+
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        flush_interval: float = FSM_FLUSH_INTERVAL,
+        ttl: float = FSM_STATE_TTL,
+        purge_interval: float = FSM_PURGE_INTERVAL,
+    ) -> None:
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._pending: Dict[str, dict] = {}
+        self._flushing: Dict[str, dict] = {}
+        self._flush_lock = asyncio.Lock()
+        self._last_purge = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                 key.business_connection_id, key.destiny)
+        return ":".join("" if part is None else str(part) for part in parts)
+
+    async def _load(self, key: str) -> dict:
+        record = self._pending.get(key)
+        if record is None:
+            record = self._flushing.get(key)
+        if record is None:
+            record = await get_fsm_record(
+                key, time.time() - self.ttl, self.db_path)
+        if record is None:
+            record = {"state": None, "data": {}}
+        return record
+
+    async def _for_update(self, key: str) -> dict:
+        record = await self._load(key)
+        # Another write may have buffered this key while we were reading
+        record = self._pending.setdefault(
+            key, {"state": record["state"], "data": record["data"]})
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return record
+
+    async def set_state(
+        self, key: StorageKey, state: StateType = None
+    ) -> None:
+        record = await self._for_update(self._key(key))
+        record["state"] = state.state if isinstance(state, State) else state
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key)))["state"]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = await self._for_update(self._key(key))
+        record["data"] = dict(data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(self._key(key)))["data"])
+
+    async def flush(self) -> None:
+        """Write all buffered changes to SQLite now."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            try:
+                await save_fsm_records(self._flushing, self.db_path)
+            except Exception:
+                # Keep them for the next flush; newer writes win
+                for key, record in self._flushing.items():
+                    self._pending.setdefault(key, record)
+                raise
+            finally:
+                self._flushing = {}
+
+    async def purge(self) -> int:
+        """Delete states that have been idle for longer than the TTL."""
+        self._last_purge = time.monotonic()
+        count = await delete_stale_fsm_records(
+            time.time() - self.ttl, self.db_path)
+        if count:
+            logger.info("Purged %s abandoned FSM states", count)
+        return count
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_purge >= self.purge_interval:
+                    await self.purge()
+            except Exception as e:
+                logger.error("FSM flush failed: %s", e)
+
+    async def close(self) -> None:
+        """Stop the flush task and write what is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,136 @@
+"""Process pool for Pillow work, kept off the event loop.
+
+Decoding and resizing a full-size photo holds the GIL for long enough to
+stall every other update, so rendition creation runs in worker processes. At
+most ``IMAGE_QUEUE_SIZE`` jobs may be running or waiting at once; beyond
+that ``ImageQueueFull`` is raised so the caller can ask the atelier to
+retry instead of piling up work.
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.types import PhotoSize
+
+from atelier_bot.db.db import (RENDITION_SIZES, add_image_source,
+                               create_artwork_renditions, create_image,
+                               find_image_by_source)
+
+logger = logging.getLogger(__name__)
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_QUEUE_SIZE = int(os.getenv("IMAGE_QUEUE_SIZE", "8"))
+
+
+class ImageQueueFull(Exception):
+    """Raised when too many images are already being processed."""
+
+
+class ImageExecutor:
+    """A process pool with a bounded number of outstanding jobs."""
+
+    def __init__(
+        self, workers: int = IMAGE_WORKERS,
+        queue_size: int = IMAGE_QUEUE_SIZE
+    ) -> None:
+        self.queue_size = queue_size
+        self.pending = 0
+        # spawn rather than fork: the parent has aiosqlite worker threads
+        # and a running loop that must not be duplicated into children.
+        self._pool = ProcessPoolExecutor(
+            max_workers=max(1, workers),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.queue_size:
+            raise ImageQueueFull()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+_executor: Optional[ImageExecutor] = None
+
+
+def get_image_executor() -> ImageExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ImageExecutor()
+    return _executor
+
+
+def shutdown_image_executor() -> None:
+    """Stop the worker processes. Called from ``main`` on shutdown."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+def pick_photo_size(
+    photos: List[PhotoSize],
+    size: tuple = (max(RENDITION_SIZES), max(RENDITION_SIZES)),
+) -> PhotoSize:
+    """Pick the smallest Telegram size that still fills ``size``.
+
+    ``photos`` is ``Message.photo``, ordered from smallest to largest.
+    Falls back to the largest size when none is big enough.
+    """
+    for photo in photos:
+        if photo.width >= size[0] or photo.height >= size[1]:
+            return photo
+    return photos[-1]
+
+
+async def make_artwork_renditions(
+    image_data: bytes
+) -> Optional[Dict[int, bytes]]:
+    """Run ``create_artwork_renditions`` in the image process pool."""
+    return await get_image_executor().run(
+        create_artwork_renditions, image_data)
+
+
+async def store_artwork_photo(
+    bot: Bot, photos: List[PhotoSize]
+) -> Optional[int]:
+    """Turn an uploaded photo into a stored image and return its id.
+
+    A photo seen before, by Telegram ``file_unique_id`` or by the SHA-256
+    of its bytes, resolves to the existing image without any download,
+    Pillow work or storage. Returns None if the renditions can't be made;
+    raises ``ImageQueueFull`` when the pool is saturated.
+    """
+    photo = pick_photo_size(photos)
+    telegram_key = f"tg:{photo.file_unique_id}"
+    image_id = await find_image_by_source(telegram_key)
+    if image_id is not None:
+        return image_id
+
+    # Download the photo; the buffer's bytes go to the worker as-is
+    photo_file = await bot.download(photo.file_id)
+    photo_data = photo_file.getvalue()
+
+    content_key = f"sha256:{hashlib.sha256(photo_data).hexdigest()}"
+    image_id = await find_image_by_source(content_key)
+    if image_id is not None:
+        await add_image_source(image_id, telegram_key)
+        return image_id
+
+    renditions = await make_artwork_renditions(photo_data)
+    if not renditions:
+        return None
+    return await create_image(
+        renditions, source_keys=(telegram_key, content_key))
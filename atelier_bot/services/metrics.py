@@ -0,0 +1,200 @@
+"""Process-wide metrics, rendered in Prometheus text format.
+
+A deliberately small subset of the Prometheus client: counters, gauges and
+histograms with optional labels, registered in ``REGISTRY`` when created
+and dumped by ``render``. ``start_metrics_server`` serves them on
+``METRICS_HOST:METRICS_PORT/metrics``.
+"""
+
+import functools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 disables the endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, doc: str, labels: Tuple[str, ...] = ()
+    ) -> None:
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: Dict[LabelValues, float] = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self._key(labels), 0.0)
+
+    def _format_labels(self, key: LabelValues) -> str:
+        if not key:
+            return ""
+        pairs = ",".join(
+            f'{label}="{_escape(value)}"'
+            for label, value in zip(self.labels, key))
+        return "{" + pairs + "}"
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(key)} {value:g}"
+                for key, value in sorted(self.values.items())]
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}",
+                f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: a count per bucket, then the sum and total count
+        self.series: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def get(self, **labels: str) -> float:
+        """Return the number of observations."""
+        series = self.series.get(self._key(labels))
+        return series[-1] if series else 0.0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, series in sorted(self.series.items()):
+            labels = self._format_labels(key)
+            for bound, count in zip(self.buckets, series):
+                lines.append(self._bucket(key, f"{bound:g}", count))
+            lines.append(self._bucket(key, "+Inf", series[-1]))
+            lines.append(f"{self.name}_sum{labels} {series[-2]:g}")
+            lines.append(f"{self.name}_count{labels} {series[-1]:g}")
+        return lines
+
+    def _bucket(self, key: LabelValues, bound: str, count: float) -> str:
+        pairs = [f'{label}="{_escape(value)}"'
+                 for label, value in zip(self.labels, key)]
+        pairs.append(f'le="{bound}"')
+        return f"{self.name}_bucket{{{','.join(pairs)}}} {count:g}"
+
+
+def timed(
+    histogram: Histogram, errors: Optional[Counter] = None, **labels: str
+) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+    """Decorate a coroutine function to record its duration and errors."""
+    def decorator(
+        fn: Callable[..., Awaitable[Any]]
+    ) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def _escape(value: str) -> str:
+    return (value.replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+REGISTRY: List[Metric] = []
+
+
+def render() -> str:
+    """Return every registered metric in Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain",
+                        charset="utf-8")
+
+
+_runner: Optional[web.AppRunner] = None
+
+
+async def start_metrics_server(
+    host: str = METRICS_HOST, port: int = METRICS_PORT
+) -> None:
+    """Serve ``/metrics`` for Prometheus; does nothing if ``port`` is 0."""
+    global _runner
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logger.info("Serving metrics on %s:%s/metrics", host, port)
+
+
+async def stop_metrics_server() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -1,35 +1,53 @@
-import base64
 import os
+from typing import Optional
 
 from aiogram import Bot
-from aiogram.types import BufferedInputFile
 
 from atelier_bot.db.db import get_artwork_by_name_and_user
+from atelier_bot.services.photos import NOTIFY_SIZE, send_artwork_photo
+from atelier_bot.services.telegram_api import create_session
 
 # Get atelier ID from environment variable, fallback to default
 ATELIER_ID = int(os.getenv("ATELIER_ID", "144227441"))
 
 
+# Long-lived fallback bot for callers that don't pass their own
+_bot: Optional[Bot] = None
+
+
+def _get_bot() -> Optional[Bot]:
+    global _bot
+    if _bot is None:
+        token = os.getenv("BOT_TOKEN")
+        if not token:
+            return None
+        _bot = Bot(token=token, session=create_session())
+    return _bot
+
+
+async def close_notify_bot() -> None:
+    """Close the fallback bot's HTTP session. Called from ``main``."""
+    global _bot
+    if _bot is not None:
+        await _bot.session.close()
+        _bot = None
+
+
 async def notify_atelier(
     user_id: int, username: str, art_name: str, paper_name: str,
-    copies: int, sheets: int
+    copies: int, sheets: int, bot: Optional[Bot] = None
 ) -> None:
-    token = os.getenv("BOT_TOKEN")
-    if not token:
+    """Send the order to the atelier chat.
+
+    Pass the dispatcher's ``bot`` so the message reuses its keep-alive
+    HTTP session; without one a single shared bot is created on demand.
+    """
+    bot = bot or _get_bot()
+    if bot is None:
         return
-    bot = Bot(token=token)
 
     # Get artwork icon
     artwork = await get_artwork_by_name_and_user(user_id, art_name)
-    icon_data = None
-    if artwork and artwork.get("image_icon"):
-        icon_b64 = artwork["image_icon"]
-        if icon_b64.startswith("data:image"):
-            icon_b64 = icon_b64.split(",", 1)[1]
-        try:
-            icon_data = base64.b64decode(icon_b64)
-        except Exception:
-            pass
 
     text = (
         "🖨 Новый заказ на печать\n\n"
@@ -40,10 +58,9 @@ async def notify_atelier(
         f"📊 Листов: {sheets}"
     )
 
-    if icon_data:
-        icon_file = BufferedInputFile(icon_data, filename="artwork_icon.jpg")
-        await bot.send_photo(ATELIER_ID, photo=icon_file, caption=text)
-    else:
+    sent = None
+    if artwork and artwork.get("has_icon"):
+        sent = await send_artwork_photo(
+            bot, ATELIER_ID, artwork, text, size=NOTIFY_SIZE)
+    if not sent:
         await bot.send_message(ATELIER_ID, text)
-
-    await bot.session.close()
@@ -0,0 +1,132 @@
+"""Dispatcher for the durable notification outbox.
+
+``place_order`` writes the order and its pending notification in one
+transaction. This dispatcher leases due rows in batches, hands them to
+the delivery queue and marks them sent once Telegram accepted them. Rows
+left unsent by a crash or an outage come back when their lease expires,
+so every notification is delivered at least once.
+
+A lease has to outlast the row's wait in the rate-limited queue, or the
+row would be claimed again while still queued and sent twice. So a batch
+is no bigger than the queue can send within one lease, and the next batch
+is claimed only once the queue has worked through the previous one.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from aiogram import Bot
+
+from atelier_bot.db.db import (DB_PATH, claim_notifications,
+                               mark_notification_sent)
+from atelier_bot.services.delivery import (DeliveryQueue, Job,
+                                           get_delivery_queue)
+from atelier_bot.services.notify import ATELIER_ID, notify_atelier
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+# Seconds a claimed row stays invisible before it is retried
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "30"))
+# Safety-net poll when nobody calls wake()
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+
+
+class OutboxDispatcher:
+    def __init__(
+        self,
+        bot: Bot,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        lease: float = OUTBOX_LEASE,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+        db_path: str = DB_PATH,
+    ) -> None:
+        self.bot = bot
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.db_path = db_path
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def wake(self) -> None:
+        """Drain now instead of at the next poll."""
+        self._wakeup.set()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def batch_limit(self, queue: DeliveryQueue) -> int:
+        """Rows the queue can send to the atelier within one lease."""
+        return max(1, min(self.batch_size,
+                          queue.burst + int(self.lease * queue.rate)))
+
+    async def drain_once(self) -> int:
+        """Lease one batch and queue it for delivery; return its size."""
+        queue = get_delivery_queue()
+        rows = await claim_notifications(
+            self.batch_limit(queue), self.lease, self.db_path)
+        for row in rows:
+            queue.submit(ATELIER_ID, self._job(row))
+        return len(rows)
+
+    def _job(self, row: dict) -> Job:
+        async def send() -> None:
+            await notify_atelier(**row["payload"], bot=self.bot)
+            await mark_notification_sent(row["id"], self.db_path)
+        return send
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                queue = get_delivery_queue()
+                limit = self.batch_limit(queue)
+                count = await self.drain_once()
+                # Rows still queued must not be leased again
+                await queue.join()
+                if count == limit:
+                    continue
+            except Exception as e:
+                logger.error("Outbox drain failed: %s", e)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+_dispatcher: Optional[OutboxDispatcher] = None
+
+
+def start_outbox_dispatcher(bot: Bot) -> OutboxDispatcher:
+    """Start draining the outbox, beginning with rows left from last run."""
+    global _dispatcher
+    _dispatcher = OutboxDispatcher(bot)
+    _dispatcher.start()
+    return _dispatcher
+
+
+def wake_outbox() -> None:
+    """Tell the dispatcher a new notification was just stored."""
+    if _dispatcher is not None:
+        _dispatcher.wake()
+
+
+async def stop_outbox_dispatcher() -> None:
+    global _dispatcher
+    if _dispatcher is not None:
+        await _dispatcher.stop()
+        _dispatcher = None
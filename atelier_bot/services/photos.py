@@ -0,0 +1,51 @@
+import logging
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message
+
+from atelier_bot.db.db import get_image_rendition, set_rendition_file_id
+
+logger = logging.getLogger(__name__)
+
+# Longest side each send site wants; the smallest rendition at least this
+# big is sent
+PREVIEW_SIZE = 320
+NOTIFY_SIZE = 800
+
+
+async def send_artwork_photo(
+    bot: Bot, chat_id: int, artwork: dict, caption: str, size: int
+) -> Optional[Message]:
+    """Send an artwork's image, reusing Telegram's file_id when known.
+
+    The first upload of a rendition stores the file_id Telegram hands
+    back; later sends reference it instead of uploading the bytes again.
+    Returns None when the artwork has no image.
+    """
+    image_id = artwork.get("image_id")
+    if not image_id:
+        return None
+    rendition = await get_image_rendition(image_id, size)
+    if not rendition:
+        return None
+
+    if rendition["file_id"]:
+        try:
+            return await bot.send_photo(chat_id, photo=rendition["file_id"],
+                                        caption=caption)
+        except TelegramBadRequest as e:
+            logger.warning("Cached file_id for image %s rejected: %s",
+                           image_id, e)
+            await set_rendition_file_id(image_id, rendition["size"], None)
+            rendition = await get_image_rendition(
+                image_id, rendition["size"], load_data=True)
+
+    photo = BufferedInputFile(
+        rendition["data"], filename=f"artwork.{rendition['format'].lower()}")
+    sent = await bot.send_photo(chat_id, photo=photo, caption=caption)
+    if sent.photo:
+        await set_rendition_file_id(
+            image_id, rendition["size"], sent.photo[-1].file_id)
+    return sent
@@ -0,0 +1,56 @@
+"""HTTP sessions for the Bot API, timed per method.
+
+Every session created here records how long each Bot API call takes and
+how many fail, labelled by method name.
+"""
+
+import os
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import (BaseRequestMiddleware,
+                                                     NextRequestMiddlewareType)
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from atelier_bot.services.metrics import Counter, Histogram
+
+# Base URL of the Bot API, e.g. a local stub or a self-hosted server
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+API_SECONDS = Histogram(
+    "atelier_telegram_api_seconds", "Bot API call duration", ("method",))
+API_ERRORS = Counter(
+    "atelier_telegram_api_errors_total", "Failed Bot API calls",
+    ("method",))
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            API_ERRORS.inc(method=name)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, method=name)
+
+
+def create_session() -> AiohttpSession:
+    """Return an HTTP session, pointed at ``TELEGRAM_API_URL`` when set."""
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(
+            api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = AiohttpSession()
+    session.middleware(ApiMetricsMiddleware())
+    return session
@@ -0,0 +1,97 @@
+"""Webhook mode: updates are pushed to an aiohttp server instead of polled.
+
+Telegram posts each update to ``WEBHOOK_PATH``. Requests without the
+secret token registered through ``set_webhook`` are rejected with 401, and
+accepted updates are processed as background tasks, so a slow handler
+holds up neither the response nor other updates. ``GET /healthz`` reports
+whether the database answers.
+"""
+
+import asyncio
+import logging
+import os
+import secrets
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import (SimpleRequestHandler,
+                                            setup_application)
+from aiohttp import web
+
+from atelier_bot.db.db import DB_PATH
+from atelier_bot.db.pool import reader
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Public base URL Telegram should call, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Random per process unless set; it is registered with set_webhook anyway
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+DB_PATH_KEY = web.AppKey("db_path", str)
+
+
+async def healthz(request: web.Request) -> web.Response:
+    try:
+        async with reader(request.app[DB_PATH_KEY]) as db:
+            cur = await db.execute("SELECT 1")
+            await cur.close()
+    except Exception as e:
+        logger.error("Health check failed: %s", e)
+        return web.json_response({"status": "error"}, status=503)
+    return web.json_response({"status": "ok"})
+
+
+def build_app(
+    bot: Bot,
+    dp: Dispatcher,
+    secret_token: str = WEBHOOK_SECRET,
+    path: str = WEBHOOK_PATH,
+    db_path: str = DB_PATH,
+) -> web.Application:
+    """Create the aiohttp app serving ``dp`` on ``path``."""
+    app = web.Application()
+    app[DB_PATH_KEY] = db_path
+    app.router.add_get("/healthz", healthz)
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=secret_token,
+        handle_in_background=True,
+    ).register(app, path=path)
+    # Runs the dispatcher's startup/shutdown hooks with the app
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(
+    bot: Bot,
+    dp: Dispatcher,
+    host: str = WEBHOOK_HOST,
+    port: int = WEBHOOK_PORT,
+) -> None:
+    """Register the webhook and serve until SIGINT or SIGTERM."""
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL environment variable is required "
+                           "in webhook mode")
+    app = build_app(bot, dp)
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        logger.info("Serving webhook on %s:%s%s", host, port, WEBHOOK_PATH)
+        await stop.wait()
+    finally:
+        await runner.cleanup()
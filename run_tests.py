@@ -64,10 +64,12 @@ def run_health_check():
     # Check if database can be initialized
     try:
         from atelier_bot.db.db import init_db
+        from atelier_bot.db.pool import close_pools
         import asyncio
 
         async def check_db():
             await init_db()
+            await close_pools()
             print("✅ Database initialization: OK")
 
         asyncio.run(check_db())
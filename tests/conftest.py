@@ -4,6 +4,10 @@ from unittest.mock import AsyncMock, MagicMock
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 
+from atelier_bot.db.cache import user_cache
+from atelier_bot.db.pool import close_pools
+from atelier_bot.db.user_index import user_index
+
 
 @pytest.fixture(scope="session")
 def event_loop():
@@ -13,6 +17,15 @@ def event_loop():
     loop.close()
 
 
+@pytest.fixture(autouse=True)
+def close_db_pools():
+    """Close pooled connections and drop in-memory caches after each test."""
+    yield
+    asyncio.run(close_pools())
+    user_cache.clear()
+    user_index.clear()
+
+
 @pytest.fixture
 async def mock_bot():
     """Mock bot instance."""
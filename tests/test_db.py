@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 import base64
 from io import BytesIO
@@ -5,16 +6,31 @@ from PIL import Image
 
 # Test database functions
 from atelier_bot.db.db import (
-    create_artwork_icon,
     create_or_update_user,
     search_users,
     get_artworks_for_user,
     get_papers_for_user,
     add_paper_for_user,
     create_artwork,
-    create_order,
-    get_all_users
+    get_all_users,
+    create_artwork_renditions,
+    create_image,
+    add_image_source,
+    find_image_by_source,
+    claim_notifications,
+    mark_notification_sent,
+    get_artwork_by_id,
+    get_artwork_by_name_and_user,
+    get_image_rendition,
+    set_rendition_file_id,
+    get_user,
+    get_paper_by_id,
+    place_order,
+    init_db
 )
+from atelier_bot.db.migrations import SCHEMA_VERSION, get_schema_version
+from atelier_bot.db.pool import ConnectionPool, get_pool
+from atelier_bot.services.imaging import ImageExecutor, ImageQueueFull
 
 
 @pytest.fixture
@@ -28,25 +44,52 @@ def sample_image_data():
 
 
 class TestArtworkIcon:
-    def test_create_artwork_icon_success(self, sample_image_data):
-        """Test successful icon creation."""
-        result = create_artwork_icon(sample_image_data, (50, 50))
+    def test_rendition_fits_its_size(self, sample_image_data):
+        """Test that a rendition is a JPEG within its size."""
+        result = create_artwork_renditions(
+            sample_image_data, sizes=(50,), fmt='JPEG')[50]
 
         assert result is not None
-        assert result.startswith("data:image/jpeg;base64,")
+        assert result.startswith(b"\xff\xd8")
 
-        # Decode and verify it's a valid image
-        base64_data = result.split(",")[1]
-        decoded = base64.b64decode(base64_data)
-        img = Image.open(BytesIO(decoded))
+        # Verify it's a valid image
+        img = Image.open(BytesIO(result))
 
         # Should be resized to thumbnail
         assert img.size[0] <= 50
         assert img.size[1] <= 50
 
-    def test_create_artwork_icon_invalid_data(self):
-        """Test icon creation with invalid data."""
-        result = create_artwork_icon(b"invalid image data")
+    def test_rendition_from_large_jpeg_and_png(self):
+        """Test draft decoding of big JPEGs and plain decoding of PNGs."""
+        for fmt in ('JPEG', 'PNG'):
+            img = Image.new('RGB', (2400, 1600), color='blue')
+            buffer = BytesIO()
+            img.save(buffer, format=fmt)
+
+            result = create_artwork_renditions(
+                buffer.getvalue(), sizes=(100,), fmt='JPEG')[100]
+
+            assert Image.open(BytesIO(result)).size == (100, 67)
+
+    def test_pick_photo_size(self):
+        """Test that the smallest size covering the icon is chosen."""
+        from aiogram.types import PhotoSize
+
+        from atelier_bot.services.imaging import pick_photo_size
+
+        sizes = [
+            PhotoSize(file_id=str(w), file_unique_id=str(w),
+                      width=w, height=w * 3 // 4)
+            for w in (90, 320, 800, 1280)
+        ]
+        assert pick_photo_size(sizes).width == 800
+        assert pick_photo_size(sizes, (100, 100)).width == 320
+        assert pick_photo_size(sizes, (1000, 1000)).width == 1280
+        assert pick_photo_size(sizes, (2000, 2000)).width == 1280
+
+    def test_renditions_from_invalid_data(self):
+        """Test that unreadable uploads produce no renditions."""
+        result = create_artwork_renditions(b"invalid image data")
         assert result is None
 
 
@@ -61,11 +104,605 @@ class TestDatabaseOperations:
         assert callable(search_users)
         assert callable(add_paper_for_user)
         assert callable(create_artwork)
-        assert callable(create_order)
+        assert callable(place_order)
         assert callable(get_all_users)
         assert callable(get_papers_for_user)
         assert callable(get_artworks_for_user)
 
+    @pytest.mark.asyncio
+    async def test_search_users_ranks_prefix_then_substring(self, tmp_path):
+        """Test trigram search ranking and the short-prefix fallback."""
+        db_path = str(tmp_path / "search.db")
+        await init_db(db_path)
+        for user_id, name in enumerate(
+                ["hanna", "Annabel", "ann", "bob", None], start=1):
+            await create_or_update_user(user_id, name, db_path)
+
+        found = await search_users("ANN", db_path)
+        assert [u["username"] for u in found] == ["ann", "Annabel", "hanna"]
+        found = await search_users("an", db_path)
+        assert [u["username"] for u in found] == ["ann", "Annabel"]
+        assert await search_users("4", db_path) == [
+            {"user_id": 4, "username": "bob"}]
+
+    @pytest.mark.asyncio
+    async def test_renamed_user_is_reindexed(self, tmp_path):
+        """Test that the upsert keeps the search index in sync."""
+        db_path = str(tmp_path / "rename.db")
+        await init_db(db_path)
+        await create_or_update_user(1, "oldname", db_path)
+        await create_or_update_user(1, "newname", db_path)
+
+        assert await search_users("oldname", db_path) == []
+        assert await search_users("newn", db_path) == [
+            {"user_id": 1, "username": "newname"}]
+
+    @pytest.mark.asyncio
+    async def test_keyset_pages_walk_both_ways(self, tmp_path):
+        """Test forward and backward keyset pagination."""
+        from atelier_bot.db.db import get_artworks_page
+
+        db_path = str(tmp_path / "pages.db")
+        await init_db(db_path)
+        for n in range(5):
+            await create_artwork(1, f"Art {n}", db_path=db_path)
+        await create_artwork(2, "Other", db_path=db_path)
+
+        first = await get_artworks_page(1, limit=2, db_path=db_path)
+        assert [a["id"] for a in first["items"]] == [1, 2]
+        assert (first["has_prev"], first["has_next"]) == (False, True)
+
+        last = await get_artworks_page(1, after_id=4, limit=2,
+                                       db_path=db_path)
+        assert [a["id"] for a in last["items"]] == [5]
+        assert (last["has_prev"], last["has_next"]) == (True, False)
+
+        back = await get_artworks_page(1, before_id=5, limit=2,
+                                       db_path=db_path)
+        assert [a["id"] for a in back["items"]] == [3, 4]
+        assert (back["has_prev"], back["has_next"]) == (True, True)
+
+    @pytest.mark.asyncio
+    async def test_get_artwork_by_id_is_scoped_to_owner(self, tmp_path):
+        """Test that an artwork id only resolves for its owner."""
+        db_path = str(tmp_path / "lookup.db")
+        await init_db(db_path)
+        await create_artwork(1, "Art", db_path=db_path)
+        art = (await get_artworks_for_user(1, db_path))[0]
+
+        assert await get_artwork_by_id(art["id"], 1, db_path) == art
+        assert await get_artwork_by_id(art["id"], 2, db_path) is None
+
+
+class TestImageExecutor:
+    """Test the process pool used for icon creation."""
+
+    @pytest.mark.asyncio
+    async def test_renditions_created_in_worker(self, sample_image_data):
+        """Test that the pool returns the same renditions as a direct call."""
+        executor = ImageExecutor(workers=1, queue_size=2)
+        try:
+            result = await executor.run(
+                create_artwork_renditions, sample_image_data)
+        finally:
+            executor.shutdown()
+        assert result == create_artwork_renditions(sample_image_data)
+
+    @pytest.mark.asyncio
+    async def test_full_queue_rejects_work(self):
+        """Test that submissions beyond the queue size are refused."""
+        import time
+
+        executor = ImageExecutor(workers=1, queue_size=1)
+        try:
+            busy = asyncio.ensure_future(executor.run(time.sleep, 0.2))
+            await asyncio.sleep(0)
+            with pytest.raises(ImageQueueFull):
+                await executor.run(time.sleep, 0)
+            await busy
+            assert executor.pending == 0
+        finally:
+            executor.shutdown()
+
+
+class TestArtworkImageStorage:
+    """Test that images live in their own tables, apart from artwork rows."""
+
+    def test_renditions_from_one_upload(self):
+        """Test that every rendition size is produced in one call."""
+        img = Image.new('RGB', (1600, 1200), color='green')
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG')
+
+        renditions = create_artwork_renditions(buffer.getvalue())
+
+        assert {
+            size: Image.open(BytesIO(data)).size
+            for size, data in renditions.items()
+        } == {100: (100, 75), 320: (320, 240), 800: (800, 600)}
+
+    def test_renditions_in_webp(self, sample_image_data):
+        """Test that the rendition format is configurable."""
+        renditions = create_artwork_renditions(
+            sample_image_data, sizes=(50,), fmt='WEBP')
+        assert Image.open(BytesIO(renditions[50])).format == 'WEBP'
+
+    @pytest.mark.asyncio
+    async def test_smallest_fitting_rendition(
+        self, tmp_path, sample_image_data
+    ):
+        """Test rendition lookup and that listings carry no image bytes."""
+        db_path = str(tmp_path / "images.db")
+        await init_db(db_path)
+        await create_or_update_user(1, "artist", db_path)
+        renditions = {100: b"small", 320: b"medium", 800: b"large"}
+        image_id = await create_image(renditions, db_path=db_path)
+        await create_artwork(1, "With icon", image_id, db_path)
+        await create_artwork(1, "Plain", db_path=db_path)
+
+        artworks = await get_artworks_for_user(1, db_path)
+
+        assert [(a["artwork_name"], bool(a["has_icon"])) for a in artworks] \
+            == [("With icon", True), ("Plain", False)]
+        assert artworks[0]["image_id"] == image_id
+        for wanted, expected in ((50, 100), (320, 320), (500, 800),
+                                 (2000, 800)):
+            rendition = await get_image_rendition(
+                image_id, wanted, db_path=db_path)
+            assert rendition["size"] == expected
+            assert rendition["data"] == renditions[expected]
+
+    @pytest.mark.asyncio
+    async def test_cached_file_id_skips_data(self, tmp_path):
+        """Test that rendition bytes aren't read once a file_id is known."""
+        db_path = str(tmp_path / "file_id.db")
+        await init_db(db_path)
+        image_id = await create_image({100: b"icon"}, db_path=db_path)
+        await set_rendition_file_id(image_id, 100, "abc", db_path)
+
+        rendition = await get_image_rendition(image_id, 100, db_path=db_path)
+        assert (rendition["file_id"], rendition["data"]) == ("abc", None)
+
+        rendition = await get_image_rendition(
+            image_id, 100, load_data=True, db_path=db_path)
+        assert rendition["data"] == b"icon"
+
+    @pytest.mark.asyncio
+    async def test_image_found_by_source_key(self, tmp_path):
+        """Test that upload fingerprints resolve to the stored image."""
+        db_path = str(tmp_path / "sources.db")
+        await init_db(db_path)
+        image_id = await create_image(
+            {100: b"icon"}, source_keys=("tg:abc", "sha256:def"),
+            db_path=db_path)
+        await add_image_source(image_id, "tg:other", db_path)
+
+        for key in ("tg:abc", "sha256:def", "tg:other"):
+            assert await find_image_by_source(key, db_path) == image_id
+        assert await find_image_by_source("tg:missing", db_path) is None
+
+    @pytest.mark.asyncio
+    async def test_legacy_base64_icons_migrated(
+        self, tmp_path, sample_image_data
+    ):
+        """Test that data-URL icons from old databases become renditions."""
+        import sqlite3
+
+        db_path = str(tmp_path / "legacy_icons.db")
+        conn = sqlite3.connect(db_path)
+        conn.executescript(
+            "CREATE TABLE artworks (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " user_id INTEGER NOT NULL, artwork_name TEXT NOT NULL,"
+            " image_icon TEXT);"
+        )
+        data_url = "data:image/jpeg;base64," + base64.b64encode(
+            sample_image_data).decode()
+        conn.execute(
+            "INSERT INTO artworks (user_id, artwork_name, image_icon)"
+            " VALUES (1, 'Old', ?)",
+            (data_url,),
+        )
+        conn.commit()
+        conn.close()
+
+        await init_db(db_path)
+
+        artwork = await get_artwork_by_name_and_user(1, "Old", db_path)
+        assert artwork["has_icon"]
+        rendition = await get_image_rendition(
+            artwork["image_id"], 320, db_path=db_path)
+        assert (rendition["size"], rendition["data"]) \
+            == (100, sample_image_data)
+
+
+class TestNotificationOutbox:
+    """Test the transactional notification outbox."""
+
+    @pytest.mark.asyncio
+    async def test_order_and_notification_stored_together(self, tmp_path):
+        """Test that a stored order has a claimable notification."""
+        db_path = str(tmp_path / "outbox.db")
+        await init_db(db_path)
+        await create_artwork(1, "Art", db_path=db_path)
+        await add_paper_for_user(1, "A4", 5, db_path)
+        order_id = (await place_order(
+            1, 1, 1, 2, 3, "2026-01-01T00:00:00", username="artist",
+            db_path=db_path))["order_id"]
+        payload = {"user_id": 1, "username": "artist", "art_name": "Art",
+                   "paper_name": "A4", "copies": 2, "sheets": 3}
+
+        claimed = await claim_notifications(10, 30, db_path)
+
+        assert [(c["order_id"], c["payload"], c["attempts"])
+                for c in claimed] == [(order_id, payload, 1)]
+        # Leased rows are hidden until the lease runs out
+        assert await claim_notifications(10, 30, db_path) == []
+
+    @pytest.mark.asyncio
+    async def test_expired_lease_is_retried_until_sent(self, tmp_path):
+        """Test at-least-once delivery across lost acknowledgements."""
+        db_path = str(tmp_path / "lease.db")
+        await init_db(db_path)
+        await create_artwork(1, "Art", db_path=db_path)
+        await add_paper_for_user(1, "A4", 5, db_path)
+        await place_order(1, 1, 1, 1, 1, "now", db_path=db_path)
+
+        first = await claim_notifications(10, 0, db_path)
+        retried = await claim_notifications(10, 0, db_path)
+        assert retried[0]["id"] == first[0]["id"]
+        assert retried[0]["attempts"] == 2
+
+        await mark_notification_sent(first[0]["id"], db_path)
+        assert await claim_notifications(10, 0, db_path) == []
+
+
+class TestPlaceOrder:
+    """Test atomic order placement."""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_orders_never_overdraw(self, tmp_path):
+        """Test that only orders covered by the balance go through."""
+        db_path = str(tmp_path / "place.db")
+        await init_db(db_path)
+        await create_or_update_user(1, "buyer", db_path)
+        await create_artwork(1, "Art", db_path=db_path)
+        await add_paper_for_user(1, "A4", 5, db_path)
+        paper = (await get_papers_for_user(1, db_path))[0]
+
+        results = await asyncio.gather(*(
+            place_order(1, paper["id"], 1, 1, 2, "now", db_path=db_path)
+            for _ in range(4)
+        ))
+
+        placed = [r for r in results if r["order_id"] is not None]
+        assert len(placed) == 2
+        assert sorted(r["quantity"] for r in placed) == [1, 3]
+        assert all(r["quantity"] == 1 for r in results
+                   if r["order_id"] is None)
+        assert (await get_paper_by_id(paper["id"], db_path))["quantity"] == 1
+        # Rejected orders leave no notification behind
+        assert len(await claim_notifications(10, 30, db_path)) == 2
+
+    @pytest.mark.asyncio
+    async def test_other_users_paper_is_rejected(self, tmp_path):
+        """Test that a paper id belonging to someone else is not used."""
+        db_path = str(tmp_path / "owner.db")
+        await init_db(db_path)
+        await add_paper_for_user(1, "A4", 5, db_path)
+        await create_artwork(2, "Art", db_path=db_path)
+        paper = (await get_papers_for_user(1, db_path))[0]
+
+        assert await place_order(2, paper["id"], 1, 1, 1, "now",
+                                 db_path=db_path) is None
+        assert (await get_paper_by_id(paper["id"], db_path))["quantity"] == 5
+
+    @pytest.mark.asyncio
+    async def test_other_users_artwork_is_rejected(self, tmp_path):
+        """Test that an artwork id belonging to someone else is not used."""
+        db_path = str(tmp_path / "art_owner.db")
+        await init_db(db_path)
+        await create_artwork(2, "Art", db_path=db_path)
+        await add_paper_for_user(1, "A4", 5, db_path)
+
+        assert await place_order(1, 1, 1, 1, 1, "now",
+                                 db_path=db_path) is None
+        assert (await get_paper_by_id(1, db_path))["quantity"] == 5
+
+
+class TestUserCache:
+    """Test the read-through cache for per-user lookups."""
+
+    @pytest.mark.asyncio
+    async def test_repeated_reads_skip_sqlite(self, tmp_path):
+        """Test that reads are cached and writers invalidate them."""
+        from atelier_bot.db.cache import user_cache
+
+        db_path = str(tmp_path / "cache.db")
+        await init_db(db_path)
+        await add_paper_for_user(1, "A4", 5, db_path)
+        await create_artwork(1, "Art", db_path=db_path)
+
+        first = await get_papers_for_user(1, db_path)
+        first[0]["quantity"] = 0  # callers get copies
+        assert await get_papers_for_user(1, db_path) == [
+            {"id": 1, "paper_name": "A4", "quantity": 5}]
+        assert (user_cache.hits, user_cache.misses) == (1, 1)
+
+        await place_order(1, 1, 1, 1, 2, "now", notify=False,
+                          db_path=db_path)
+        assert (await get_papers_for_user(1, db_path))[0]["quantity"] == 3
+        assert user_cache.misses == 2
+
+    @pytest.mark.asyncio
+    async def test_first_page_is_cached_until_a_write(self, tmp_path):
+        """Test that reopening the menu reads the first page from cache."""
+        from atelier_bot.db.cache import user_cache
+        from atelier_bot.db.db import get_papers_page
+
+        db_path = str(tmp_path / "page_cache.db")
+        await init_db(db_path)
+        await create_artwork(1, "Art", db_path=db_path)
+        await add_paper_for_user(1, "A4", 5, db_path)
+
+        first = await get_papers_page(1, db_path=db_path)
+        first["items"][0]["quantity"] = 0  # callers get copies
+        again = await get_papers_page(1, db_path=db_path)
+        assert again["items"][0]["quantity"] == 5
+        assert (user_cache.hits, user_cache.misses) == (1, 1)
+
+        await place_order(1, 1, 1, 1, 2, "now", notify=False,
+                          db_path=db_path)
+        assert (await get_papers_page(1, db_path=db_path))[
+            "items"][0]["quantity"] == 3
+        assert user_cache.misses == 2
+
+    @pytest.mark.asyncio
+    async def test_hits_and_misses_are_exported(self, tmp_path):
+        """Test that user cache lookups show up on /metrics."""
+        from atelier_bot.db.cache import CACHE_LOOKUPS
+        from atelier_bot.services.metrics import render
+
+        db_path = str(tmp_path / "cache_metrics.db")
+        await init_db(db_path)
+        hits = CACHE_LOOKUPS.get(cache="user", result="hit")
+        misses = CACHE_LOOKUPS.get(cache="user", result="miss")
+
+        await get_user(1, db_path)
+        await get_user(1, db_path)
+
+        assert CACHE_LOOKUPS.get(cache="user", result="hit") == hits + 1
+        assert CACHE_LOOKUPS.get(cache="user", result="miss") == misses + 1
+        assert ('atelier_cache_lookups_total{cache="user",result="hit"}'
+                in render())
+
+    def test_lru_and_ttl(self):
+        """Test eviction of the oldest entry and of expired ones."""
+        from atelier_bot.db.cache import MISSING, TTLCache
+
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is MISSING
+        assert cache.stats() == {"hits": 1, "misses": 1, "size": 2}
+
+        cache.ttl = 0
+        cache.set("d", 4)
+        assert cache.get("d") is MISSING
+
+    @pytest.mark.asyncio
+    async def test_load_racing_a_write_is_not_stored(self):
+        """Test that a value read before an invalidation isn't cached."""
+        from atelier_bot.db.cache import MISSING, TTLCache
+
+        cache = TTLCache(maxsize=2, ttl=60)
+
+        async def load():
+            cache.invalidate("k")  # a writer commits mid-read
+            return "stale"
+
+        assert await cache.get_or_load("k", load) == "stale"
+        assert cache.get("k") is MISSING
+
+
+class TestUsernameIndex:
+    """Test the in-memory username prefix index."""
+
+    @pytest.mark.asyncio
+    async def test_index_follows_user_writes(self, tmp_path):
+        """Test loading, prefix lookup and updates on upsert."""
+        from atelier_bot.db.db import load_user_index
+        from atelier_bot.db.user_index import user_index
+
+        db_path = str(tmp_path / "index.db")
+        await init_db(db_path)
+        for user_id, name in enumerate(["anna", "Annabel", "bob"], start=1):
+            await create_or_update_user(user_id, name, db_path)
+        await load_user_index(db_path)
+
+        assert user_index.prefix("ANN", 10) == [
+            {"user_id": 1, "username": "anna"},
+            {"user_id": 2, "username": "Annabel"},
+        ]
+        assert user_index.prefix("ann", 1) == [
+            {"user_id": 1, "username": "anna"}]
+
+        await create_or_update_user(1, "zoe", db_path)
+        await create_or_update_user(4, "annette", db_path)
+        assert [u["user_id"] for u in user_index.prefix("ann", 10)] == [2, 4]
+        assert user_index.prefix("z", 10) == [{"user_id": 1,
+                                               "username": "zoe"}]
+        assert len(user_index) == 4
+
+
+class TestConnectionPool:
+    """Test the shared connection pool."""
+
+    @pytest.mark.asyncio
+    async def test_pool_reused_across_calls(self, tmp_path):
+        """Test that helpers share one pool per database file."""
+        db_path = str(tmp_path / "pool.db")
+        await init_db(db_path)
+        pool = await get_pool(db_path)
+
+        await create_or_update_user(1, "artist", db_path)
+
+        assert await get_pool(db_path) is pool
+        assert await get_user(1, db_path) == {
+            "user_id": 1, "username": "artist"
+        }
+
+    @pytest.mark.asyncio
+    async def test_writer_rolls_back_on_error(self, tmp_path):
+        """Test that a failed write block leaves no partial changes."""
+        pool = ConnectionPool(str(tmp_path / "rollback.db"), size=1)
+        await pool.open()
+        try:
+            async with pool.writer() as db:
+                await db.execute("CREATE TABLE t (x INTEGER)")
+
+            with pytest.raises(RuntimeError):
+                async with pool.writer() as db:
+                    await db.execute("INSERT INTO t VALUES (1)")
+                    raise RuntimeError("boom")
+
+            async with pool.reader() as db:
+                cur = await db.execute("SELECT COUNT(*) FROM t")
+                (count,) = await cur.fetchone()
+                await cur.close()
+            assert count == 0
+        finally:
+            await pool.close()
+
+
+    @pytest.mark.asyncio
+    async def test_queued_writes_are_exported(self, tmp_path):
+        """Test the writer queue depth gauge."""
+        from atelier_bot.db.pool import DB_WRITES_WAITING
+
+        pool = ConnectionPool(str(tmp_path / "queue.db"), size=1)
+        await pool.open()
+        try:
+            async def write():
+                async with pool.writer():
+                    pass
+
+            async with pool.writer():
+                waiting = asyncio.create_task(write())
+                await asyncio.sleep(0.01)
+                assert DB_WRITES_WAITING.get() == 1
+            await waiting
+            assert DB_WRITES_WAITING.get() == 0
+        finally:
+            await pool.close()
+
+    @pytest.mark.asyncio
+    async def test_pragma_profile_applied(self, tmp_path):
+        """Test WAL mode on the writer and query_only on readers."""
+        pool = ConnectionPool(str(tmp_path / "pragmas.db"), size=1)
+        await pool.open()
+        try:
+            async with pool.writer() as db:
+                cur = await db.execute("PRAGMA journal_mode")
+                (mode,) = await cur.fetchone()
+                await cur.close()
+            assert mode == "wal"
+
+            async with pool.reader() as db:
+                cur = await db.execute("PRAGMA query_only")
+                (query_only,) = await cur.fetchone()
+                await cur.close()
+            assert query_only == 1
+        finally:
+            await pool.close()
+
+    @pytest.mark.asyncio
+    async def test_writes_run_in_submission_order(self, tmp_path):
+        """Test that concurrent writers are queued, not interleaved."""
+        pool = ConnectionPool(str(tmp_path / "order.db"), size=1)
+        await pool.open()
+        order = []
+
+        async def write(n):
+            async with pool.writer():
+                order.append(("start", n))
+                await asyncio.sleep(0)
+                order.append(("end", n))
+
+        try:
+            await asyncio.gather(*(write(n) for n in range(3)))
+        finally:
+            await pool.close()
+
+        assert order == [
+            (step, n) for n in range(3) for step in ("start", "end")
+        ]
+
+
+class TestMigrations:
+    """Test the versioned schema migration runner."""
+
+    @pytest.mark.asyncio
+    async def test_init_db_is_idempotent(self, tmp_path):
+        """Test that init_db upgrades once and re-runs as a no-op."""
+        db_path = str(tmp_path / "migrate.db")
+        await init_db(db_path)
+        await init_db(db_path)
+
+        pool = await get_pool(db_path)
+        async with pool.reader() as db:
+            assert await get_schema_version(db) == SCHEMA_VERSION
+            cur = await db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+                " AND name LIKE 'idx_%'"
+            )
+            indexes = {row[0] for row in await cur.fetchall()}
+            await cur.close()
+
+        assert {
+            "idx_paper_balance_user",
+            "idx_artworks_user",
+            "idx_orders_user",
+            "idx_orders_status",
+        } <= indexes
+
+    @pytest.mark.asyncio
+    async def test_unversioned_database_is_upgraded(self, tmp_path):
+        """Test that a pre-migration database keeps its data."""
+        import sqlite3
+
+        db_path = str(tmp_path / "legacy.db")
+        conn = sqlite3.connect(db_path)
+        conn.executescript(
+            "CREATE TABLE users (user_id INTEGER PRIMARY KEY,"
+            " username TEXT);"
+            "INSERT INTO users VALUES (7, 'legacy');"
+        )
+        conn.close()
+
+        await init_db(db_path)
+
+        assert await get_user(7, db_path) == {
+            "user_id": 7, "username": "legacy"
+        }
+
+    @pytest.mark.asyncio
+    async def test_user_lookup_uses_index(self, tmp_path):
+        """Test that per-user artwork lookups no longer scan the table."""
+        db_path = str(tmp_path / "plan.db")
+        await init_db(db_path)
+        pool = await get_pool(db_path)
+        async with pool.reader() as db:
+            cur = await db.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM artworks"
+                " WHERE user_id = ? AND artwork_name = ?",
+                (1, "art"),
+            )
+            plan = " ".join(row[-1] for row in await cur.fetchall())
+            await cur.close()
+        assert "idx_artworks_user" in plan
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
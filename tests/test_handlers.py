@@ -85,5 +85,252 @@ class TestDatabaseIntegration:
         assert callable(create_or_update_user)
 
 
+class TestPrintFlowState:
+    """Test what the print flow keeps in FSM state."""
+
+    @pytest.mark.asyncio
+    async def test_choose_artwork_stores_only_id(self):
+        """Test that choosing an artwork stores its id, not its details."""
+        from atelier_bot.handlers.print_handler import choose_artwork
+
+        callback = MagicMock()
+        callback.data = "art_7"
+        callback.from_user.id = 123
+        callback.answer = AsyncMock()
+        callback.message.edit_text = AsyncMock()
+        mock_state = AsyncMock(spec=FSMContext)
+        art = {"id": 7, "artwork_name": "Art", "image_id": None,
+               "has_icon": 0}
+
+        with (
+            patch('atelier_bot.handlers.print_handler.get_artwork_by_id',
+                  return_value=art) as mock_get_art,
+            patch('atelier_bot.handlers.print_handler.get_papers_page',
+                  return_value={"items": [], "has_prev": False,
+                                "has_next": False})
+        ):
+            await choose_artwork(callback, mock_state)
+
+        mock_get_art.assert_called_once_with(7, 123)
+        mock_state.update_data.assert_called_once_with(art_id=7)
+
+
+class TestEditInPlace:
+    """Test that callback steps edit their message instead of sending."""
+
+    @pytest.mark.asyncio
+    async def test_cancel_edits_menu_and_answers(self):
+        """Test that cancel turns the message back into the main menu."""
+        from atelier_bot.handlers.print_handler import cancel_action
+
+        callback = MagicMock()
+        callback.from_user.id = 123
+        callback.answer = AsyncMock()
+        callback.message.edit_text = AsyncMock()
+        callback.message.answer = AsyncMock()
+        mock_state = AsyncMock(spec=FSMContext)
+
+        await cancel_action(callback, mock_state)
+
+        callback.answer.assert_called_once()
+        callback.message.edit_text.assert_called_once()
+        callback.message.answer.assert_not_called()
+        mock_state.clear.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_falls_back_to_new_message(self):
+        """Test that a message that can't be edited is sent anew."""
+        from aiogram.exceptions import TelegramBadRequest
+
+        from atelier_bot.handlers.print_handler import choose_paper
+
+        callback = MagicMock()
+        callback.data = "paper_3"
+        callback.from_user.id = 123
+        callback.answer = AsyncMock()
+        callback.message.edit_text = AsyncMock(side_effect=TelegramBadRequest(
+            method=MagicMock(), message="message can't be edited"))
+        callback.message.answer = AsyncMock()
+        mock_state = AsyncMock(spec=FSMContext)
+        paper = {"id": 3, "user_id": 123, "paper_name": "Matte",
+                 "quantity": 5}
+
+        with patch('atelier_bot.handlers.print_handler.get_paper_by_id',
+                   return_value=paper):
+            await choose_paper(callback, mock_state)
+
+        callback.answer.assert_called_once_with()
+        callback.message.answer.assert_called_once()
+        mock_state.update_data.assert_called_once_with(paper_id=3)
+
+    @pytest.mark.asyncio
+    async def test_unchanged_message_is_left_alone(self):
+        """Test that a double tap doesn't send a duplicate menu."""
+        from aiogram.exceptions import TelegramBadRequest
+
+        from atelier_bot.handlers.print_handler import cancel_action
+
+        callback = MagicMock()
+        callback.from_user.id = 123
+        callback.answer = AsyncMock()
+        callback.message.edit_text = AsyncMock(side_effect=TelegramBadRequest(
+            method=MagicMock(),
+            message="Bad Request: message is not modified: specified new "
+                    "message content and reply markup are exactly the same"))
+        callback.message.answer = AsyncMock()
+
+        await cancel_action(callback, AsyncMock(spec=FSMContext))
+
+        callback.answer.assert_called_once()
+        callback.message.answer.assert_not_called()
+
+
+class TestInlineUserSearch:
+    """Test the atelier's inline user picker."""
+
+    @pytest.mark.asyncio
+    async def test_results_come_from_username_index(self):
+        """Test that matching users are offered with their id as text."""
+        from atelier_bot.db.user_index import user_index
+        from atelier_bot.handlers.print_handler import (ATELIER_ID,
+                                                        INLINE_CACHE_TIME,
+                                                        inline_user_search)
+
+        user_index.load("test.db", [
+            {"user_id": 5, "username": "anna"},
+            {"user_id": 6, "username": "bob"},
+        ])
+        query = MagicMock()
+        query.from_user.id = ATELIER_ID
+        query.query = "@An"
+        query.answer = AsyncMock()
+
+        await inline_user_search(query)
+
+        results = query.answer.call_args.args[0]
+        assert [(r.title, r.input_message_content.message_text)
+                for r in results] == [("@anna", "5")]
+        assert query.answer.call_args.kwargs["cache_time"] == \
+            INLINE_CACHE_TIME
+
+    @pytest.mark.asyncio
+    async def test_other_users_get_nothing(self):
+        """Test that only the atelier can search users."""
+        from atelier_bot.db.user_index import user_index
+        from atelier_bot.handlers.print_handler import inline_user_search
+
+        user_index.load("test.db", [{"user_id": 5, "username": "anna"}])
+        query = MagicMock()
+        query.from_user.id = 1
+        query.query = "a"
+        query.answer = AsyncMock()
+
+        await inline_user_search(query)
+
+        assert query.answer.call_args.args[0] == []
+
+
+class TestKeyboardPaging:
+    """Test page navigation in the artwork keyboard."""
+
+    @pytest.mark.asyncio
+    async def test_next_page_edits_markup_in_place(self):
+        """Test that paging edits the keyboard instead of sending anew."""
+        from atelier_bot.handlers.print_handler import page_artworks
+
+        callback = MagicMock()
+        callback.data = "arts_next_8"
+        callback.from_user.id = 123
+        callback.answer = AsyncMock()
+        callback.message.answer = AsyncMock()
+        callback.message.edit_reply_markup = AsyncMock()
+        page = {"items": [{"id": 9, "artwork_name": "Art"}],
+                "has_prev": True, "has_next": False}
+
+        with patch('atelier_bot.handlers.print_handler.get_artworks_page',
+                   return_value=page) as mock_page:
+            await page_artworks(callback)
+
+        mock_page.assert_called_once_with(123, after_id=8)
+        markup = callback.message.edit_reply_markup.call_args.kwargs[
+            "reply_markup"]
+        assert [b.callback_data for row in markup.inline_keyboard
+                for b in row] == ["art_9", "arts_prev_9", "cancel"]
+        callback.message.answer.assert_not_called()
+        callback.answer.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_double_tap_is_answered_without_error(self):
+        """Test that an unchanged page still clears the button spinner."""
+        from aiogram.exceptions import TelegramBadRequest
+
+        from atelier_bot.handlers.print_handler import page_papers
+
+        callback = MagicMock()
+        callback.data = "papers_next_8"
+        callback.from_user.id = 123
+        callback.answer = AsyncMock()
+        callback.message.edit_reply_markup = AsyncMock(
+            side_effect=TelegramBadRequest(
+                method=MagicMock(),
+                message="Bad Request: message is not modified"))
+        page = {"items": [{"id": 9, "paper_name": "A4", "quantity": 2}],
+                "has_prev": True, "has_next": False}
+
+        with patch('atelier_bot.handlers.print_handler.get_papers_page',
+                   return_value=page):
+            await page_papers(callback)
+
+        callback.answer.assert_called_once_with()
+
+
+class TestKeyboardReuse:
+    """Test that keyboards are built once and reused."""
+
+    def test_static_keyboards_share_frozen_buttons(self):
+        """Test that each role reuses its buttons, which can't be changed."""
+        from pydantic import ValidationError
+
+        from atelier_bot.keyboards.print_keyboards import (confirm_keyboard,
+                                                           main_menu_keyboard,
+                                                           main_reply_keyboard)
+
+        first, second = main_menu_keyboard(True), main_menu_keyboard(True)
+        assert first.inline_keyboard[0][0] is second.inline_keyboard[0][0]
+        assert (main_reply_keyboard(False).keyboard[0][0]
+                is main_reply_keyboard(False).keyboard[0][0])
+        assert (confirm_keyboard().inline_keyboard[0][0]
+                is confirm_keyboard().inline_keyboard[0][0])
+        with pytest.raises(ValidationError):
+            first.inline_keyboard[0][0].text = "changed"
+
+    def test_changing_a_keyboard_does_not_spread(self):
+        """Test that a caller's changes stay in its own markup."""
+        from aiogram.types import InlineKeyboardButton
+
+        from atelier_bot.keyboards.print_keyboards import main_menu_keyboard
+
+        kb = main_menu_keyboard(False)
+        kb.inline_keyboard.append(
+            [InlineKeyboardButton(text="x", callback_data="x")])
+        kb.inline_keyboard[0].append(
+            InlineKeyboardButton(text="y", callback_data="y"))
+
+        assert [[b.callback_data for b in row] for row in
+                main_menu_keyboard(False).inline_keyboard] == [["print"]]
+
+    def test_unchanged_rows_reuse_buttons(self):
+        """Test that buttons are rebuilt only when their data changes."""
+        from atelier_bot.keyboards.print_keyboards import papers_keyboard
+
+        first = papers_keyboard([{"id": 1, "paper_name": "A", "quantity": 5},
+                                 {"id": 2, "paper_name": "B", "quantity": 3}])
+        second = papers_keyboard([{"id": 1, "paper_name": "A", "quantity": 5},
+                                  {"id": 2, "paper_name": "B", "quantity": 2}])
+
+        assert first.inline_keyboard[0][0] is second.inline_keyboard[0][0]
+        assert second.inline_keyboard[1][0].text == "B (2)"
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
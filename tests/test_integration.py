@@ -1,6 +1,7 @@
+import asyncio
 import pytest
 import os
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from atelier_bot.services.notify import notify_atelier
 
@@ -10,24 +11,53 @@ class TestNotificationService:
 
     @pytest.mark.asyncio
     async def test_notify_atelier_success(self):
-        """Test successful atelier notification."""
+        """Test successful atelier notification through the caller's bot."""
 
         with (
             patch('atelier_bot.services.notify.Bot') as mock_bot_class,
             patch('atelier_bot.services.notify.get_artwork_by_name_and_user')
-            as mock_get_artwork,
-            patch.dict(os.environ, {'BOT_TOKEN': 'test_token'})
+            as mock_get_artwork
         ):
 
             mock_bot_instance = AsyncMock()
-            mock_bot_class.return_value = mock_bot_instance
 
             mock_get_artwork.return_value = None  # No artwork icon
 
-            await notify_atelier(123, "testuser", "Test Art", "A4", 5, 1)
+            await notify_atelier(123, "testuser", "Test Art", "A4", 5, 1,
+                                 bot=mock_bot_instance)
 
-            mock_bot_class.assert_called_once_with(token='test_token')
+            mock_bot_class.assert_not_called()
             mock_bot_instance.send_message.assert_called_once()
+            mock_bot_instance.session.close.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_notify_atelier_shared_fallback_bot(self):
+        """Test that the fallback bot is built once and kept open."""
+        from atelier_bot.services.notify import close_notify_bot
+
+        with (
+            patch('atelier_bot.services.notify.Bot') as mock_bot_class,
+            patch('atelier_bot.services.notify.get_artwork_by_name_and_user')
+            as mock_get_artwork,
+            patch.dict(os.environ, {'BOT_TOKEN': 'test_token'})
+        ):
+
+            mock_bot_instance = AsyncMock()
+            mock_bot_class.return_value = mock_bot_instance
+            mock_get_artwork.return_value = None
+
+            try:
+                await notify_atelier(123, "testuser", "Test Art", "A4", 5, 1)
+                await notify_atelier(123, "testuser", "Test Art", "A4", 5, 1)
+
+                mock_bot_class.assert_called_once()
+                assert mock_bot_class.call_args.kwargs['token'] == \
+                    'test_token'
+                assert mock_bot_instance.send_message.call_count == 2
+                mock_bot_instance.session.close.assert_not_called()
+            finally:
+                await close_notify_bot()
+            mock_bot_instance.session.close.assert_called_once()
 
     @pytest.mark.asyncio
     async def test_notify_atelier_no_token(self):
@@ -41,30 +71,682 @@ class TestNotificationService:
         """Test notification with artwork image."""
 
         with (
-            patch('atelier_bot.services.notify.Bot') as mock_bot_class,
             patch('atelier_bot.services.notify.get_artwork_by_name_and_user')
             as mock_get_artwork,
-            patch.dict(os.environ, {'BOT_TOKEN': 'test_token'})
+            patch('atelier_bot.services.photos.get_image_rendition')
+            as mock_get_rendition,
+            patch('atelier_bot.services.photos.set_rendition_file_id')
+            as mock_set_file_id
         ):
 
             mock_bot_instance = AsyncMock()
-            mock_bot_class.return_value = mock_bot_instance
 
-            # Mock artwork with valid base64 image
-            import base64
+            # Mock artwork with a stored JPEG icon
             from PIL import Image
             img = Image.new('RGB', (10, 10), color='red')
             from io import BytesIO
             buffer = BytesIO()
             img.save(buffer, format='JPEG')
-            img_b64 = base64.b64encode(buffer.getvalue()).decode()
             mock_get_artwork.return_value = {
-                'image_icon': f'data:image/jpeg;base64,{img_b64}'
+                'id': 1, 'image_id': 5, 'has_icon': 1
+            }
+            mock_get_rendition.return_value = {
+                'size': 800, 'format': 'JPEG', 'file_id': None,
+                'data': buffer.getvalue()
             }
 
-            await notify_atelier(123, "testuser", "Test Art", "A4", 5, 1)
+            sent = MagicMock()
+            sent.photo = [MagicMock(file_id="small"), MagicMock(file_id="big")]
+            mock_bot_instance.send_photo.return_value = sent
+
+            await notify_atelier(123, "testuser", "Test Art", "A4", 5, 1,
+                                 bot=mock_bot_instance)
 
             mock_bot_instance.send_photo.assert_called_once()
+            mock_get_rendition.assert_called_once_with(5, 800)
+            mock_set_file_id.assert_called_once_with(5, 800, "big")
+
+
+class TestArtworkPhotoCache:
+    """Test that artwork images are sent by cached Telegram file_id."""
+
+    @pytest.mark.asyncio
+    async def test_cached_file_id_skips_upload(self):
+        """Test that a known file_id is sent without uploading bytes."""
+        from atelier_bot.services.photos import send_artwork_photo
+
+        bot = AsyncMock()
+        with patch('atelier_bot.services.photos.get_image_rendition',
+                   return_value={'size': 320, 'format': 'JPEG',
+                                 'file_id': 'cached', 'data': None}):
+            await send_artwork_photo(
+                bot, 42, {'id': 1, 'image_id': 5}, "caption", size=320)
+
+        bot.send_photo.assert_called_once_with(
+            42, photo='cached', caption="caption")
+
+    @pytest.mark.asyncio
+    async def test_rejected_file_id_falls_back_to_upload(self):
+        """Test that a stale file_id is replaced by a fresh upload."""
+        from aiogram.exceptions import TelegramBadRequest
+        from aiogram.methods import SendPhoto
+        from aiogram.types import BufferedInputFile
+
+        from atelier_bot.services.photos import send_artwork_photo
+
+        sent = MagicMock()
+        sent.photo = [MagicMock(file_id="fresh")]
+        bot = AsyncMock()
+        bot.send_photo.side_effect = [
+            TelegramBadRequest(SendPhoto(chat_id=42, photo='stale'),
+                               "wrong file identifier"),
+            sent,
+        ]
+        with (
+            patch('atelier_bot.services.photos.get_image_rendition',
+                  side_effect=[
+                      {'size': 320, 'format': 'JPEG', 'file_id': 'stale',
+                       'data': None},
+                      {'size': 320, 'format': 'JPEG', 'file_id': None,
+                       'data': b"jpeg"},
+                  ]),
+            patch('atelier_bot.services.photos.set_rendition_file_id')
+            as mock_set_file_id
+        ):
+            result = await send_artwork_photo(
+                bot, 42, {'id': 1, 'image_id': 5}, "caption", size=320)
+
+        assert result is sent
+        uploaded = bot.send_photo.call_args_list[1].kwargs['photo']
+        assert isinstance(uploaded, BufferedInputFile)
+        assert mock_set_file_id.call_args_list[-1].args == (5, 320, "fresh")
+
+
+class TestPhotoDeduplication:
+    """Test that repeated uploads reuse the stored image."""
+
+    @staticmethod
+    def _photos():
+        from aiogram.types import PhotoSize
+
+        return [PhotoSize(file_id="f1", file_unique_id="u1",
+                          width=1280, height=960)]
+
+    @pytest.mark.asyncio
+    async def test_known_file_unique_id_skips_download(self):
+        """Test that a Telegram fingerprint hit needs no download."""
+        from atelier_bot.services.imaging import store_artwork_photo
+
+        bot = AsyncMock()
+        with patch('atelier_bot.services.imaging.find_image_by_source',
+                   return_value=7) as mock_find:
+            image_id = await store_artwork_photo(bot, self._photos())
+
+        assert image_id == 7
+        mock_find.assert_called_once_with("tg:u1")
+        bot.download.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_known_bytes_skip_processing(self):
+        """Test that a content hash hit skips Pillow and storage."""
+        import hashlib
+        from io import BytesIO
+
+        from atelier_bot.services.imaging import store_artwork_photo
+
+        bot = AsyncMock()
+        bot.download.return_value = BytesIO(b"jpeg")
+        digest = hashlib.sha256(b"jpeg").hexdigest()
+        with (
+            patch('atelier_bot.services.imaging.find_image_by_source',
+                  side_effect=[None, 7]) as mock_find,
+            patch('atelier_bot.services.imaging.add_image_source')
+            as mock_add_source,
+            patch('atelier_bot.services.imaging.make_artwork_renditions')
+            as mock_renditions,
+            patch('atelier_bot.services.imaging.create_image')
+            as mock_create_image
+        ):
+            image_id = await store_artwork_photo(bot, self._photos())
+
+        assert image_id == 7
+        assert mock_find.call_args.args == (f"sha256:{digest}",)
+        mock_add_source.assert_called_once_with(7, "tg:u1")
+        mock_renditions.assert_not_called()
+        mock_create_image.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_new_photo_is_processed_and_fingerprinted(self):
+        """Test that a new photo is stored under both fingerprints."""
+        from io import BytesIO
+
+        from atelier_bot.services.imaging import store_artwork_photo
+
+        bot = AsyncMock()
+        bot.download.return_value = BytesIO(b"jpeg")
+        with (
+            patch('atelier_bot.services.imaging.find_image_by_source',
+                  return_value=None),
+            patch('atelier_bot.services.imaging.make_artwork_renditions',
+                  return_value={100: b"icon"}),
+            patch('atelier_bot.services.imaging.create_image',
+                  return_value=9) as mock_create_image
+        ):
+            image_id = await store_artwork_photo(bot, self._photos())
+
+        assert image_id == 9
+        keys = mock_create_image.call_args.kwargs['source_keys']
+        assert keys[0] == "tg:u1"
+        assert keys[1].startswith("sha256:")
+
+
+class TestDeliveryQueue:
+    """Test background delivery with rate limiting and retries."""
+
+    def test_token_bucket_spaces_out_bursts(self):
+        """Test that reservations beyond the burst have to wait."""
+        from atelier_bot.services.delivery import TokenBucket
+
+        bucket = TokenBucket(rate=2, capacity=2)
+        waits = [bucket.reserve() for _ in range(4)]
+
+        assert waits[:2] == [0, 0]
+        assert waits[2] == pytest.approx(0.5, abs=0.01)
+        assert waits[3] == pytest.approx(1.0, abs=0.01)
+
+    @pytest.mark.asyncio
+    async def test_submit_returns_before_delivery(self):
+        """Test that submit doesn't wait for the send to happen."""
+        from atelier_bot.services.delivery import DeliveryQueue
+
+        queue = DeliveryQueue(rate=100, burst=10)
+        sent = []
+
+        async def job():
+            sent.append("sent")
+
+        queue.submit(1, job)
+        assert sent == []
+        await queue.join()
+        assert sent == ["sent"]
+        await queue.stop()
+
+    @pytest.mark.asyncio
+    async def test_retry_after_is_honoured(self):
+        """Test that flood-control and network errors are retried."""
+        from aiogram.exceptions import (TelegramNetworkError,
+                                        TelegramRetryAfter)
+        from aiogram.methods import SendMessage
+
+        from atelier_bot.services.delivery import DeliveryQueue
+
+        method = SendMessage(chat_id=1, text="hi")
+        job = AsyncMock(side_effect=[
+            TelegramRetryAfter(method, "flood", retry_after=3),
+            TelegramNetworkError(method, "timeout"),
+            "ok",
+        ])
+        queue = DeliveryQueue(rate=100, burst=10, base_delay=0.5)
+        real_sleep = asyncio.sleep
+        delays = []
+
+        async def fake_sleep(delay):
+            if delay:
+                delays.append(delay)
+            await real_sleep(0)
+
+        with patch('atelier_bot.services.delivery.asyncio.sleep',
+                   fake_sleep):
+            assert await queue.deliver(1, job) == "ok"
+
+        assert delays == [3, 1.0]
+
+    @pytest.mark.asyncio
+    async def test_gives_up_after_max_attempts(self):
+        """Test that a permanently failing job stops being retried."""
+        from aiogram.exceptions import TelegramServerError
+        from aiogram.methods import SendMessage
+
+        from atelier_bot.services.delivery import DeliveryQueue
+
+        job = AsyncMock(side_effect=TelegramServerError(
+            SendMessage(chat_id=1, text="hi"), "bad gateway"))
+        queue = DeliveryQueue(rate=100, burst=10, max_attempts=3,
+                              base_delay=0)
+
+        queue.submit(1, job)
+        await queue.join()
+        await queue.stop()
+
+        assert job.call_count == 3
+
+
+class TestOutboxDispatcher:
+    """Test draining the notification outbox."""
+
+    @pytest.mark.asyncio
+    async def test_drained_rows_are_sent_then_marked(self):
+        """Test that a row is marked sent only after notify succeeds."""
+        from atelier_bot.services.delivery import DeliveryQueue
+        from atelier_bot.services.outbox import OutboxDispatcher
+
+        payload = {"user_id": 1, "username": "artist", "art_name": "Art",
+                   "paper_name": "A4", "copies": 1, "sheets": 2}
+        bot = AsyncMock()
+        queue = DeliveryQueue(rate=100, burst=10)
+        with (
+            patch('atelier_bot.services.outbox.claim_notifications',
+                  return_value=[{"id": 3, "order_id": 8,
+                                 "payload": payload, "attempts": 1}]),
+            patch('atelier_bot.services.outbox.get_delivery_queue',
+                  return_value=queue),
+            patch('atelier_bot.services.outbox.notify_atelier')
+            as mock_notify,
+            patch('atelier_bot.services.outbox.mark_notification_sent')
+            as mock_mark_sent
+        ):
+            dispatcher = OutboxDispatcher(bot, batch_size=5)
+            assert await dispatcher.drain_once() == 1
+            await queue.join()
+            await queue.stop()
+
+        mock_notify.assert_called_once_with(**payload, bot=bot)
+        mock_mark_sent.assert_called_once_with(3, dispatcher.db_path)
+
+    @pytest.mark.asyncio
+    async def test_failed_delivery_leaves_row_pending(self):
+        """Test that a failed send is not acknowledged."""
+        from atelier_bot.services.delivery import DeliveryQueue
+        from atelier_bot.services.outbox import OutboxDispatcher
+
+        queue = DeliveryQueue(rate=100, burst=10)
+        with (
+            patch('atelier_bot.services.outbox.claim_notifications',
+                  return_value=[{"id": 3, "order_id": 8,
+                                 "payload": {}, "attempts": 1}]),
+            patch('atelier_bot.services.outbox.get_delivery_queue',
+                  return_value=queue),
+            patch('atelier_bot.services.outbox.notify_atelier',
+                  side_effect=RuntimeError("down")),
+            patch('atelier_bot.services.outbox.mark_notification_sent')
+            as mock_mark_sent
+        ):
+            await OutboxDispatcher(AsyncMock()).drain_once()
+            await queue.join()
+            await queue.stop()
+
+        mock_mark_sent.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_backlog_longer_than_a_lease_is_sent_once(self, tmp_path):
+        """Test that rows waiting in the queue are not leased again."""
+        from atelier_bot.db.db import (add_paper_for_user, claim_notifications,
+                                       create_artwork, init_db, place_order)
+        from atelier_bot.services.delivery import DeliveryQueue
+        from atelier_bot.services.outbox import OutboxDispatcher
+
+        db_path = str(tmp_path / "backlog.db")
+        await init_db(db_path)
+        await create_artwork(1, "Art", db_path=db_path)
+        await add_paper_for_user(1, "A4", 100, db_path)
+        for copies in range(12):
+            await place_order(1, 1, 1, copies, 1, "now", db_path=db_path)
+
+        sent = []
+
+        async def notify(copies, bot, **payload):
+            sent.append(copies)
+
+        # Sending the backlog takes about three leases
+        queue = DeliveryQueue(rate=10, burst=1)
+        with (
+            patch('atelier_bot.services.outbox.get_delivery_queue',
+                  return_value=queue),
+            patch('atelier_bot.services.outbox.notify_atelier',
+                  side_effect=notify)
+        ):
+            dispatcher = OutboxDispatcher(
+                AsyncMock(), batch_size=20, lease=0.3, poll_interval=0.05,
+                db_path=db_path)
+            dispatcher.start()
+            for _ in range(100):
+                if len(sent) >= 12:
+                    break
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(0.5)
+            await dispatcher.stop()
+            await queue.stop()
+
+        assert sorted(sent) == list(range(12))
+        assert await claim_notifications(20, 30, db_path) == []
+
+
+class TestFSMStorage:
+    """Test the SQLite-backed FSM storage."""
+
+    @staticmethod
+    def _key(user_id=1):
+        from aiogram.fsm.storage.base import StorageKey
+        return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+    @pytest.mark.asyncio
+    async def test_state_survives_restart(self, tmp_path):
+        """Test that buffered writes are visible and persisted on close."""
+        from atelier_bot.db.db import get_fsm_record, init_db
+        from atelier_bot.handlers.print_handler import OrderStates
+        from atelier_bot.services.fsm_storage import SQLiteStorage
+
+        db_path = str(tmp_path / "fsm.db")
+        await init_db(db_path)
+        storage = SQLiteStorage(db_path, flush_interval=60)
+        await storage.set_state(self._key(), OrderStates.entering_copies)
+        await storage.update_data(self._key(), {"art_id": 7})
+
+        # Visible right away, but not written yet
+        assert await storage.get_state(self._key()) == \
+            OrderStates.entering_copies.state
+        assert await get_fsm_record(
+            SQLiteStorage._key(self._key()), db_path=db_path) is None
+        await storage.close()
+
+        restarted = SQLiteStorage(db_path)
+        assert await restarted.get_state(self._key()) == \
+            OrderStates.entering_copies.state
+        assert await restarted.get_data(self._key()) == {"art_id": 7}
+        assert await restarted.get_data(self._key(2)) == {}
+
+    @pytest.mark.asyncio
+    async def test_cleared_and_expired_states_are_dropped(self, tmp_path):
+        """Test that cleared states are deleted and idle ones expire."""
+        from atelier_bot.db.db import get_fsm_record, init_db
+        from atelier_bot.services.fsm_storage import SQLiteStorage
+
+        db_path = str(tmp_path / "ttl.db")
+        await init_db(db_path)
+        storage = SQLiteStorage(db_path, ttl=3600)
+        for user_id in (1, 2):
+            await storage.set_state(self._key(user_id), "Flow:step")
+            await storage.set_data(self._key(user_id), {"n": user_id})
+        await storage.flush()
+
+        await storage.set_state(self._key(1), None)
+        await storage.set_data(self._key(1), {})
+        await storage.flush()
+        assert await get_fsm_record(
+            SQLiteStorage._key(self._key(1)), db_path=db_path) is None
+
+        storage.ttl = 0
+        assert await storage.get_state(self._key(2)) is None
+        assert await storage.purge() == 1
+        await storage.close()
+
+
+class TestWebhook:
+    """Test the webhook server against a stub Telegram API."""
+
+    @pytest.mark.asyncio
+    async def test_polling_removes_webhook_first(self):
+        """Test that polling mode drops a webhook set by an earlier run."""
+        from atelier_bot.main import run_polling
+
+        # Both mocks hang off one parent so their call order is recorded
+        calls = AsyncMock()
+        bot, dp = calls.bot, calls.dp
+
+        await run_polling(bot, dp)
+
+        assert [c[0] for c in calls.mock_calls] == [
+            "bot.delete_webhook", "dp.start_polling"]
+
+    @pytest.mark.asyncio
+    async def test_updates_are_verified_and_processed(self, tmp_path):
+        """Test secret checking, health and a full update round trip."""
+        from aiogram import Bot, Dispatcher, Router
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        from aiohttp import web
+        from aiohttp.test_utils import TestClient, TestServer
+
+        from atelier_bot.db.db import init_db
+        from atelier_bot.webhook import build_app
+
+        calls = []
+
+        async def stub_api(request):
+            calls.append(request.match_info["method"])
+            return web.json_response({"ok": True, "result": {
+                "message_id": 2, "date": 0,
+                "chat": {"id": 5, "type": "private"}, "text": "pong"}})
+
+        stub_app = web.Application()
+        stub_app.router.add_post("/bot{token}/{method}", stub_api)
+
+        router = Router()
+
+        @router.message()
+        async def pong(message):
+            await message.answer("pong")
+
+        db_path = str(tmp_path / "webhook.db")
+        await init_db(db_path)
+        async with TestServer(stub_app) as stub:
+            bot = Bot("42:TEST", session=AiohttpSession(
+                api=TelegramAPIServer.from_base(str(stub.make_url("")))))
+            dp = Dispatcher()
+            dp.include_router(router)
+            app = build_app(bot, dp, secret_token="s3cret", db_path=db_path)
+            update = {"update_id": 1, "message": {
+                "message_id": 1, "date": 0, "text": "ping",
+                "chat": {"id": 5, "type": "private"},
+                "from": {"id": 5, "is_bot": False, "first_name": "A"}}}
+
+            async with TestClient(TestServer(app)) as client:
+                health = await client.get("/healthz")
+                assert health.status == 200
+
+                denied = await client.post("/webhook", json=update)
+                assert denied.status == 401
+
+                accepted = await client.post(
+                    "/webhook", json=update,
+                    headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+                assert accepted.status == 200
+                for _ in range(100):
+                    if calls:
+                        break
+                    await asyncio.sleep(0.01)
+
+        assert calls == ["sendMessage"]
+
+
+class TestConcurrencyMiddleware:
+    """Test bounded, per-user ordered update handling."""
+
+    @pytest.mark.asyncio
+    async def test_dispatcher_routes_on_the_updated_state(self):
+        """Test that a user's next message sees the state set before it."""
+        from aiogram import Bot, Router
+        from aiogram.filters import StateFilter
+        from aiogram.fsm.state import State, StatesGroup
+        from aiogram.fsm.storage.memory import MemoryStorage
+        from aiogram.types import Update
+
+        from atelier_bot.main import create_dispatcher
+
+        class S(StatesGroup):
+            a = State()
+
+        routed = []
+        router = Router()
+
+        @router.message(StateFilter(None))
+        async def first(message, state):
+            routed.append(("first", message.text))
+            await asyncio.sleep(0.05)
+            await state.set_state(S.a)
+
+        @router.message(S.a)
+        async def second(message):
+            routed.append(("second", message.text))
+
+        dp = create_dispatcher(MemoryStorage())
+        dp.include_router(router)
+        bot = Bot("42:TEST")
+
+        def update(update_id, text):
+            return Update.model_validate({
+                "update_id": update_id, "message": {
+                    "message_id": update_id, "date": 0, "text": text,
+                    "chat": {"id": 5, "type": "private"},
+                    "from": {"id": 5, "is_bot": False, "first_name": "A"}}})
+
+        try:
+            await asyncio.gather(dp.feed_update(bot, update(1, "one")),
+                                 dp.feed_update(bot, update(2, "two")))
+        finally:
+            await bot.session.close()
+
+        assert routed == [("first", "one"), ("second", "two")]
+
+    @staticmethod
+    def _data(user_id):
+        user = MagicMock()
+        user.id = user_id
+        return {"event_from_user": user}
+
+    @pytest.mark.asyncio
+    async def test_same_user_is_serialized(self):
+        """Test that one user's updates run one at a time, in order."""
+        from atelier_bot.middlewares.concurrency import ConcurrencyMiddleware
+
+        middleware = ConcurrencyMiddleware(max_concurrent=4)
+        log = []
+
+        async def handler(event, data):
+            log.append(("start", event))
+            await asyncio.sleep(0.01)
+            log.append(("end", event))
+
+        await asyncio.gather(*(
+            middleware(handler, n, self._data(1)) for n in range(3)))
+
+        assert log == [(step, n) for n in range(3)
+                       for step in ("start", "end")]
+        assert middleware._user_locks == {}
+
+    @pytest.mark.asyncio
+    async def test_global_limit_and_shedding(self):
+        """Test the in-flight cap and dropping beyond the waiting limit."""
+        from atelier_bot.middlewares.concurrency import (UPDATES_SHED,
+                                                         ConcurrencyMiddleware)
+        from atelier_bot.services.metrics import render
+
+        middleware = ConcurrencyMiddleware(max_concurrent=2, max_pending=1)
+        release = asyncio.Event()
+        running = []
+
+        async def handler(event, data):
+            running.append(event)
+            await release.wait()
+            return event
+
+        tasks = [asyncio.create_task(middleware(handler, n, self._data(n)))
+                 for n in range(3)]
+        await asyncio.sleep(0.01)
+        shed_before = UPDATES_SHED.get()
+        assert await middleware(handler, 9, self._data(9)) is None
+        assert UPDATES_SHED.get() == shed_before + 1
+
+        assert running == [0, 1]
+        assert middleware.waiting == 1
+        release.set()
+        assert await asyncio.gather(*tasks) == [0, 1, 2]
+        assert middleware.waiting == 0
+        assert "atelier_updates_waiting 0\n" in render()
+
+
+class TestMetrics:
+    """Test latency histograms and their Prometheus rendering."""
+
+    def test_histogram_rendering(self):
+        """Test cumulative buckets, sum and count in the text format."""
+        from atelier_bot.services.metrics import REGISTRY, Histogram
+
+        histogram = Histogram("test_seconds", "Test", ("op",),
+                              buckets=(0.1, 1))
+        try:
+            histogram.observe(0.05, op="a")
+            histogram.observe(0.5, op="a")
+            assert histogram.render() == [
+                "# HELP test_seconds Test",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{op="a",le="0.1"} 1',
+                'test_seconds_bucket{op="a",le="1"} 2',
+                'test_seconds_bucket{op="a",le="+Inf"} 2',
+                'test_seconds_sum{op="a"} 0.55',
+                'test_seconds_count{op="a"} 2',
+            ]
+        finally:
+            REGISTRY.remove(histogram)
+
+    @pytest.mark.asyncio
+    async def test_db_and_handler_timings(self, tmp_path):
+        """Test that DB helpers and handlers record timings and errors."""
+        from atelier_bot.db.db import DB_QUERY_SECONDS, get_user, init_db
+        from atelier_bot.middlewares.timing import (HANDLER_ERRORS,
+                                                    HANDLER_SECONDS,
+                                                    HandlerMetricsMiddleware)
+
+        db_path = str(tmp_path / "metrics.db")
+        await init_db(db_path)
+        before = DB_QUERY_SECONDS.get(query="get_user")
+        await get_user(1, db_path)
+        assert DB_QUERY_SECONDS.get(query="get_user") == before + 1
+
+        async def failing_handler(event, data):
+            raise RuntimeError("boom")
+
+        handler_object = MagicMock()
+        handler_object.callback.__name__ = "choose_paper"
+        calls = HANDLER_SECONDS.get(handler="choose_paper")
+        errors = HANDLER_ERRORS.get(handler="choose_paper")
+        with pytest.raises(RuntimeError):
+            await HandlerMetricsMiddleware()(
+                failing_handler, MagicMock(), {"handler": handler_object})
+        assert HANDLER_SECONDS.get(handler="choose_paper") == calls + 1
+        assert HANDLER_ERRORS.get(handler="choose_paper") == errors + 1
+
+
+class TestLogging:
+    """Test the queued JSON logging setup."""
+
+    def test_json_lines_and_debug_sampling(self, capsys):
+        """Test JSON output through the queue and sampling of DEBUG."""
+        import json
+        import logging
+
+        from atelier_bot.logging_setup import setup_logging, stop_logging
+
+        root = logging.getLogger()
+        saved_handlers, saved_level = root.handlers[:], root.level
+        try:
+            setup_logging(level="DEBUG", fmt="json", debug_sample=3)
+            log = logging.getLogger("atelier_bot.test")
+            for n in range(5):
+                log.debug("tick %s", n)
+            log.info("order placed", extra={"order_id": 7})
+        finally:
+            stop_logging()
+            root.handlers[:] = saved_handlers
+            root.setLevel(saved_level)
+            logging.getLogger("aiogram").setLevel(logging.NOTSET)
+
+        lines = [json.loads(line)
+                 for line in capsys.readouterr().err.splitlines()]
+        assert [entry["msg"] for entry in lines] == [
+            "tick 0", "tick 3", "order placed"]
+        assert lines[-1]["level"] == "INFO"
+        assert lines[-1]["order_id"] == 7
 
 
 class TestIntegrationFlows:
@@ -80,7 +762,7 @@ class TestIntegrationFlows:
             get_papers_for_user,
             create_artwork,
             get_artworks_for_user,
-            create_order
+            place_order
         )
 
         # Just test that functions exist and are callable
@@ -90,7 +772,7 @@ class TestIntegrationFlows:
         assert callable(get_papers_for_user)
         assert callable(create_artwork)
         assert callable(get_artworks_for_user)
-        assert callable(create_order)
+        assert callable(place_order)
 
     @pytest.mark.asyncio
     async def test_user_auto_creation_workflow(self):